@@ -1,11 +1,17 @@
+import asyncio
 import logging
 from datetime import datetime, timedelta
-from telegram import Update, ReplyKeyboardMarkup, ForceReply, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InputFile, ReplyKeyboardMarkup, ForceReply, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler
-from data_manager import data_manager
+from data_manager import data_manager, local_date
+from compliance import compliance, is_weigh_in_day
+from telegram_clients import get_bot, close_bots, register_bot
+from outbox import outbox, INTERACTIVE
+import export
+from pagination import MESSAGE_LIMIT, PageCache, page_keyboard, page_slice, send_chunked
 import os
 from dotenv import load_dotenv
-from telegram.error import Forbidden
+from telegram.error import BadRequest, Forbidden
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -55,119 +61,99 @@ async def show_general_stats(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if update.effective_user.id != ADMIN_ID:
         return
         
-    users = data_manager.get_all_users()
+    # Статистика всех участников и итоги за один проход
+    report = data_manager.get_all_user_stats()
+    totals = report['totals']
     
-    if not users:
+    if not report['users']:
         await update.message.reply_text(
             "Пока нет активных участников.",
             reply_markup=admin_keyboard
         )
         return
     
-    total_users = len(users)
-    active_today = 0
-    total_meals = 0
-    total_cardio = 0
-    total_strength = 0
-    weight_progress = 0
+    total_users = totals['users']
+    active_today = totals['active']
     
     message = "📊 Общая статистика марафона:\n\n"
-    
-    for user in users:
-        stats = data_manager.get_user_stats(user['user_id'])
-        user_data = data_manager.load_user_data(user['user_id'])
-        
-        # Считаем активность за сегодня
-        if stats['today_meals'] > 0 or stats['today_cardio'] or stats['today_strength']:
-            active_today += 1
-            
-        # Общая статистика
-        total_meals += len(user_data.get('meals', []))
-        total_cardio += len(user_data.get('cardio', []))
-        total_strength += len(user_data.get('strength', []))
-        
-        # Считаем прогресс по весу
-        if stats['weight_diff'] < 0:
-            weight_progress += 1
-    
     message += (
         f"👥 Всего участников: {total_users}\n"
         f"📱 Активны сегодня: {active_today}\n\n"
         f"📊 Общие показатели:\n"
-        f"🍽 Приемов пищи: {total_meals}\n"
-        f"🏃‍♂️ Кардио тренировок: {total_cardio}\n"
-        f"💪 Силовых тренировок: {total_strength}\n"
-        f"⚖️ Снижают вес: {weight_progress} из {total_users}\n\n"
+        f"🍽 Приемов пищи: {totals['meals']}\n"
+        f"🏃‍♂️ Кардио тренировок: {totals['cardio']}\n"
+        f"💪 Силовых тренировок: {totals['strength']}\n"
+        f"⚖️ Снижают вес: {totals['losing_weight']} из {total_users}\n\n"
         f"💯 Средняя активность: {(active_today/total_users*100):.1f}%\n"
     )
     
     await update.message.reply_text(message, reply_markup=admin_keyboard)
 
-async def show_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показывает список всех пользователей"""
-    if update.effective_user.id != ADMIN_ID:
-        return
-        
-    users = data_manager.get_all_users()
-    
-    if not users:
-        await update.message.reply_text(
-            "Пока нет активных участников.",
-            reply_markup=admin_keyboard
+# Размер страниц списков
+USERS_PER_PAGE = 20
+PROGRESS_PER_PAGE = 15
+
+# Готовые страницы списков и список участников
+page_cache = PageCache()
+
+def get_roster(include_unreachable: bool = False):
+    """Участники по алфавиту (кэшируется до изменения данных)"""
+    key = ('roster', include_unreachable, data_manager.data_version())
+    roster = page_cache.get(key)
+    if roster is None:
+        roster = sorted(
+            data_manager.get_all_users(include_unreachable=include_unreachable),
+            key=lambda user: (user['name'].lower(), user['user_id'])
         )
-        return
+        page_cache.put(key, roster)
+    return roster
+
+def render_users_page(page: int, date: str):
+    """Страница списка участников: текст и кнопки"""
+    roster = get_roster(include_unreachable=True)
+    users, page, pages = page_slice(roster, page, USERS_PER_PAGE)
     
-    message = "👥 Список участников:\n\n"
+    message = f"👥 Список участников ({len(roster)}, стр. {page + 1}/{pages}):\n\n"
     for user in users:
-        stats = data_manager.get_user_stats(user['user_id'])
+        # Статистика считается только для участников на странице
+        stats = data_manager.get_user_stats(user['user_id'], date)
+        blocked_mark = " 🚫 недоступен" if user['delivery_status'] else ""
         message += (
-            f"• {user['name']}\n"
+            f"• {user['name']}{blocked_mark}\n"
             f"  ID: {user['user_id']}\n"
             f"  Прогресс: {stats['marathon_progress']}/90 дней\n"
             f"  Вес: {stats['weight_diff']:+.1f} кг\n\n"
         )
-    
-    await update.message.reply_text(message, reply_markup=admin_keyboard)
+    return message, page_keyboard('users', page, pages)
 
-async def show_daily_progress(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показывает прогресс за день"""
-    if update.effective_user.id != ADMIN_ID:
-        return
-        
-    users = data_manager.get_all_users()
+def render_progress_page(page: int, date: str):
+    """Страница прогресса за день: текст и кнопки"""
+    roster = get_roster()
+    users, page, pages = page_slice(roster, page, PROGRESS_PER_PAGE)
+    day = datetime.strptime(date, '%Y-%m-%d')
+    is_friday = is_weigh_in_day(date)
     
-    if not users:
-        await update.message.reply_text(
-            "Пока нет активных участников.",
-            reply_markup=admin_keyboard
-        )
-        return
-    
-    today = datetime.now()
-    is_friday = today.weekday() == 4  # 4 = пятница
+    message = f"📈 Прогресс за {day.strftime('%d.%m.%Y')} (стр. {page + 1}/{pages}):\n\n"
     
-    message = f"📈 Прогресс за {today.strftime('%d.%m.%Y')}:\n\n"
+    # Выполнение плана всей страницей из общего отчёта
+    rows = compliance.rows([user['user_id'] for user in users], date)
     
     for user in users:
-        stats = data_manager.get_user_stats(user['user_id'])
+        row = rows[user['user_id']]
         
-        meals_status = "✅" if stats['today_meals'] >= 3 else "❌"
-        cardio_status = "✅" if stats['today_cardio'] else "❌"
-        strength_status = "✅" if stats['today_strength'] else "❌"
-        weight_status = "✅" if is_friday and stats['current_weight'] else "❌" if is_friday else "➖"
+        meals_status = "✅" if row['meals_ok'] else "❌"
+        cardio_status = "✅" if row['cardio'] else "❌"
+        strength_status = "✅" if row['strength'] else "❌"
+        # По пятницам - взвешивался ли участник с начала недели
+        weight_status = ("✅" if row['weighed_week'] else "❌") if is_friday else "➖"
         
-        all_done = (
-            stats['today_meals'] >= 3 and 
-            stats['today_cardio'] and 
-            stats['today_strength'] and 
-            (not is_friday or (is_friday and stats['current_weight']))
-        )
+        all_done = row['day_done'] and (not is_friday or row['weighed_week'])
         
         status_emoji = "🌟" if all_done else "⚠️"
         
         message += (
             f"{status_emoji} {user['name']}:\n"
-            f"🍽 Питание (3+): {meals_status} ({stats['today_meals']})\n"
+            f"🍽 Питание (3+): {meals_status} ({row['meals']})\n"
             f"🏃‍♂️ Кардио: {cardio_status}\n"
             f"💪 Силовая: {strength_status}\n"
         )
@@ -177,47 +163,132 @@ async def show_daily_progress(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         message += "\n"
     
-    await update.message.reply_text(message, reply_markup=admin_keyboard)
+    return message, page_keyboard('progress', page, pages)
+
+PAGE_VIEWS = {
+    'users': render_users_page,
+    'progress': render_progress_page
+}
+
+def render_page(view: str, page: int):
+    """Страница вида за сегодня из кэша; None - участников нет"""
+    date = local_date()
+    key = (view, date, data_manager.data_version(), page)
+    rendered = page_cache.get(key)
+    if rendered is None:
+        if not get_roster(include_unreachable=(view == 'users')):
+            return None
+        rendered = PAGE_VIEWS[view](page, date)
+        page_cache.put(key, rendered)
+    return rendered
+
+async def show_page(update: Update, view: str):
+    """Отправляет первую страницу вида"""
+    rendered = render_page(view, 0)
+    if rendered is None:
+        await update.message.reply_text(
+            "Пока нет активных участников.",
+            reply_markup=admin_keyboard
+        )
+        return
+    message, keyboard = rendered
+    await send_chunked(update.message, message, reply_markup=keyboard or admin_keyboard)
+
+async def show_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает список всех пользователей (по страницам)"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+    await show_page(update, 'users')
+
+async def show_daily_progress(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает прогресс за день (по страницам)"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+    await show_page(update, 'progress')
+
+async def handle_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание страниц кнопками ⬅️/➡️"""
+    query = update.callback_query
+    await query.answer()
+    if update.effective_user.id != ADMIN_ID:
+        return
+    
+    _, view, page = query.data.split('_')
+    if view not in PAGE_VIEWS:
+        return
+    rendered = render_page(view, int(page))
+    if rendered is None:
+        await query.edit_message_text("Пока нет активных участников.")
+        return
+    message, keyboard = rendered
+    if len(message) > MESSAGE_LIMIT:
+        await send_chunked(query.message, message, reply_markup=keyboard)
+        return
+    try:
+        await query.edit_message_text(message, reply_markup=keyboard)
+    except BadRequest as e:
+        # Страница не изменилась с прошлого показа
+        if 'not modified' not in str(e).lower():
+            raise
+
+EXPORT_USAGE = (
+    "Использование: /export [csv|xlsx] [ГГГГ-ММ-ДД или ГГГГ-ММ-ДД..ГГГГ-ММ-ДД] [ID участников]\n"
+    "Например: /export xlsx 2025-01-01..2025-01-31 123456789"
+)
+
+def parse_export_args(args):
+    """Разбирает аргументы /export: формат, период и ID участников"""
+    fmt, date_from, date_to, user_ids = 'csv', None, None, []
+    for arg in args:
+        if arg.lower() in ('csv', 'xlsx'):
+            fmt = arg.lower()
+        elif arg.isdigit():
+            user_ids.append(arg)
+        else:
+            start, _, end = arg.partition('..')
+            for value in (start, end):
+                if value:
+                    datetime.strptime(value, '%Y-%m-%d')  # ValueError для неверной даты
+            date_from = start or None
+            date_to = (end or None) if _ else start
+    return fmt, user_ids, date_from, date_to
 
 async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Экспортирует данные всех пользователей"""
+    """Выгружает активности участников файлом CSV/XLSX (с фильтрами для /export)"""
     if update.effective_user.id != ADMIN_ID:
         return
-        
-    users = data_manager.get_all_users()
     
-    if not users:
+    try:
+        fmt, user_ids, date_from, date_to = parse_export_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text(EXPORT_USAGE, reply_markup=admin_keyboard)
+        return
+    if fmt == 'xlsx' and not export.xlsx_available():
         await update.message.reply_text(
-            "Пока нет активных участников.",
+            "Выгрузка в XLSX недоступна (не установлен openpyxl), используйте csv.",
             reply_markup=admin_keyboard
         )
         return
     
-    message = "📤 Экспорт данных:\n\n"
-    
-    for user in users:
-        user_data = data_manager.load_user_data(user['user_id'])
-        stats = data_manager.get_user_stats(user['user_id'])
-        
-        message += (
-            f"👤 {user['name']} (ID: {user['user_id']}):\n"
-            f"Старт: {user['start_date']}\n"
-            f"Прогресс: {stats['marathon_progress']}/90 дней\n"
-            f"Всего активностей:\n"
-            f"- Приемов пищи: {len(user_data.get('meals', []))}\n"
-            f"- Кардио: {len(user_data.get('cardio', []))}\n"
-            f"- Силовых: {len(user_data.get('strength', []))}\n"
-        )
-        
-        if stats['current_weight']:
-            message += (
-                f"Вес: {stats['current_weight']:.1f} кг "
-                f"(изменение: {stats['weight_diff']:+.1f} кг)\n"
+    # Файл собирается в отдельном потоке, чтобы не останавливать обработку других обновлений
+    f, count = await asyncio.to_thread(export.build_export, fmt, user_ids, date_from, date_to)
+    try:
+        if count == 0:
+            await update.message.reply_text(
+                "Нет активностей для выгрузки.",
+                reply_markup=admin_keyboard
             )
+            return
         
-        message += "\n"
-    
-    await update.message.reply_text(message, reply_markup=admin_keyboard)
+        period = f"{date_from or '...'} – {date_to or '...'}" if date_from or date_to else "всё время"
+        filename = f"activities_{datetime.now().strftime('%Y%m%d_%H%M')}.{fmt}"
+        await update.message.reply_document(
+            document=InputFile(f, filename=filename),
+            caption=f"📤 Экспорт активностей: {count} строк, период: {period}",
+            reply_markup=admin_keyboard
+        )
+    finally:
+        f.close()
 
 async def start_send_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начинает процесс отправки сообщения"""
@@ -304,17 +375,20 @@ async def handle_message_input(update: Update, context: ContextTypes.DEFAULT_TYP
     message_text = update.message.text
     
     try:
-        # Создаем новый экземпляр бота для отправки сообщения
-        main_bot = Application.builder().token(BOT_TOKEN).build()
-        async with main_bot:
-            await main_bot.bot.send_message(
-                chat_id=selected_user['id'],
-                text=f"👨‍🏫 Сообщение от тренера FitTracking Bot:\n\n{message_text}"
-            )
-            await update.message.reply_text(
-                f"✅ Сообщение отправлено пользователю {selected_user['name']}",
-                reply_markup=admin_keyboard
-            )
+        # Отправляем от основного бота через общую очередь, вне очереди рассылок
+        result = await outbox.send(
+            'bot',
+            selected_user['id'],
+            f"👨‍🏫 Сообщение от тренера FitTracking Bot:\n\n{message_text}",
+            priority=INTERACTIVE,
+            track_delivery=True
+        )
+        if result != 'sent':
+            raise RuntimeError('сообщение не доставлено' if result == 'failed' else 'пользователь заблокировал бота')
+        await update.message.reply_text(
+            f"✅ Сообщение отправлено пользователю {selected_user['name']}",
+            reply_markup=admin_keyboard
+        )
     except Exception as e:
         logger.error(f"Ошибка при отправке сообщения: {e}")
         await update.message.reply_text(
@@ -392,11 +466,11 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
         message = '❌ Тренер рекомендует пересмотреть состав приёма пищи.'
     
     try:
-        # Создаем экземпляр основного бота для отправки сообщений
-        main_bot = Application.builder().token(BOT_TOKEN).build()
-        async with main_bot:
-            await main_bot.bot.send_message(chat_id=user_id, text=message)
-            await query.message.reply_text('Ответ отправлен пользователю ✅')
+        # Отправляем от основного бота через общую очередь, вне очереди рассылок
+        result = await outbox.send('bot', user_id, message, priority=INTERACTIVE, track_delivery=True)
+        if result != 'sent':
+            raise RuntimeError(f"результат отправки: {result}")
+        await query.message.reply_text('Ответ отправлен пользователю ✅')
     except Exception as e:
         logger.error(f"Ошибка при отправке ответа пользователю: {e}")
         await query.message.reply_text('❌ Ошибка при отправке ответа пользователю')
@@ -419,32 +493,26 @@ async def handle_admin_comment(update: Update, context: ContextTypes.DEFAULT_TYP
     logger.info(f"Отправка комментария пользователю {user_id} для приема пищи {meal_number}")
     
     try:
-        # Создаем экземпляр основного бота для отправки сообщений
-        main_bot = Application.builder().token(BOT_TOKEN).build()
-        async with main_bot:
-            message = (
-                f'👨‍🏫 Комментарий от тренера FitTracking Bot к приему пищи #{meal_number}:\n\n'
-                f'{comment}'
+        message = (
+            f'👨‍🏫 Комментарий от тренера FitTracking Bot к приему пищи #{meal_number}:\n\n'
+            f'{comment}'
+        )
+        
+        # Отправляем сообщение пользователю без кнопки ответа, от основного бота через общую очередь
+        result = await outbox.send('bot', user_id, message, priority=INTERACTIVE, track_delivery=True)
+        
+        if result == 'sent':
+            logger.info(f"Комментарий успешно отправлен пользователю {user_id}")
+            await update.message.reply_text(
+                '✅ Комментарий отправлен пользователю',
+                reply_markup=admin_keyboard
             )
-            
-            # Отправляем сообщение пользователю без кнопки ответа
-            sent_message = await main_bot.bot.send_message(
-                chat_id=user_id,
-                text=message
+        else:
+            logger.error("Не удалось отправить комментарий")
+            await update.message.reply_text(
+                '❌ Ошибка при отправке комментария',
+                reply_markup=admin_keyboard
             )
-            
-            if sent_message:
-                logger.info(f"Комментарий успешно отправлен пользователю {user_id}")
-                await update.message.reply_text(
-                    '✅ Комментарий отправлен пользователю',
-                    reply_markup=admin_keyboard
-                )
-            else:
-                logger.error("Не удалось отправить комментарий")
-                await update.message.reply_text(
-                    '❌ Ошибка при отправке комментария',
-                    reply_markup=admin_keyboard
-                )
     except Exception as e:
         logger.error(f"Ошибка при отправке комментария: {e}")
         await update.message.reply_text(
@@ -457,12 +525,36 @@ async def handle_admin_comment(update: Update, context: ContextTypes.DEFAULT_TYP
     
     return ConversationHandler.END
 
-def main():
-    """Запуск бота"""
-    application = Application.builder().token(ADMIN_TOKEN).build()
+async def flush_user_data(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически сбрасывает накопленные изменения данных на диск"""
+    data_manager.flush()
+
+async def post_init(application: Application):
+    """Создаёт общий клиент основного бота, запускает очередь сообщений и сброс кэша данных"""
+    register_bot(application.bot)
+    await get_bot(BOT_TOKEN)
+    await outbox.start('admin')
+    # Правки тренера и статусы доставки не ждут сброса при остановке
+    application.job_queue.run_repeating(flush_user_data, interval=data_manager.flush_interval)
+
+async def post_shutdown(application: Application):
+    """Останавливает очередь сообщений и закрывает общие клиенты"""
+    await outbox.stop()
+    await close_bots()
+
+def build_application() -> Application:
+    """Создаёт приложение бота со всеми обработчиками и задачами"""
+    application = (
+        Application.builder()
+        .token(ADMIN_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Добавляем обработчики
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("export", export_data))
     
     # Обработчик отправки сообщений
     conv_handler = ConversationHandler(
@@ -485,6 +577,9 @@ def main():
     )
     application.add_handler(comment_handler)
     
+    # Листание страниц списков
+    application.add_handler(CallbackQueryHandler(handle_page_callback, pattern='^page_'))
+    
     # Обработчик остальных callback-кнопок (одобрить/отклонить)
     application.add_handler(CallbackQueryHandler(handle_admin_callback, pattern='^(approve|reject)_'))
     
@@ -494,8 +589,11 @@ def main():
     # Добавляем обработчик ошибок
     application.add_error_handler(error_handler)
     
-    # Запускаем бота
-    application.run_polling()
+    return application
+
+def main():
+    """Запуск бота (long polling)"""
+    build_application().run_polling()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+# Боты и админ-бот читают эти переменные при импорте; сеть в замерах не используется
+os.environ.setdefault('BOT_TOKEN', 'bench:bot')
+os.environ.setdefault('ADMIN_BOT_TOKEN', 'bench:admin')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+
+import outbox as outbox_module
+import admin_bot
+import notifications
+from compliance import ComplianceEngine
+from data_manager import DataManager, data_manager
+from outbox import outbox, BOT_TOKENS
+from pagination import PageCache
+from storage import create_storage
+from telegram_clients import register_bot
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.WARNING
+)
+logger = logging.getLogger('bench')
+
+DEFAULT_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), 'data', 'bench')
+FIRST_NAMES = ['Анна', 'Иван', 'Мария', 'Олег', 'Дарья', 'Павел', 'Елена', 'Роман', 'Ольга', 'Артём']
+EXERCISES = ['Присед 4x10', 'Жим лёжа 3x8', 'Тяга 4x8', 'Выпады 3x12', 'Планка 3x60с']
+
+class FakeBot:
+    """Бот без сети: считает отправленные сообщения и изображает задержку API"""
+
+    def __init__(self, token: str, latency: float = 0.0):
+        self.token = token
+        self.latency = latency
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+
+class FakeMessage:
+    """Сообщение админа: ответы только считаются"""
+
+    def __init__(self):
+        self.replies = 0
+
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        self.replies += 1
+
+def generate_user(rnd: random.Random, index: int, days: int, end_date: datetime) -> Dict:
+    """Синтетическая запись участника за days дней по end_date включительно"""
+    start = end_date - timedelta(days=days - 1)
+    data = {
+        'name': f"{rnd.choice(FIRST_NAMES)} {index}",
+        'start_date': start.strftime('%Y-%m-%d'),
+        'meals': [],
+        'cardio': [],
+        'strength': [],
+        'weight_history': []
+    }
+    weight = rnd.uniform(60, 110)
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        date = day.strftime('%Y-%m-%d')
+        for meal in range(rnd.choice((1, 2, 3, 3, 4, 5))):
+            data['meals'].append({'date': f"{date} {8 + meal * 3:02d}:00:00", 'photo_id': f"photo_{index}_{offset}_{meal}"})
+        if rnd.random() < 0.7:
+            data['cardio'].append({'date': f"{date} 07:30:00", 'duration': rnd.randint(20, 60)})
+        if rnd.random() < 0.4:
+            data['strength'].append({'date': f"{date} 19:00:00", 'exercises': rnd.choice(EXERCISES)})
+        # Взвешивание - по пятницам, вес понемногу снижается
+        if day.weekday() == 4 or offset == 0:
+            weight += rnd.uniform(-1.0, 0.3)
+            data['weight_history'].append({'date': date, 'weight': round(weight, 1)})
+    return data
+
+def generate_roster(manager: DataManager, users: int, days: int, seed: int = 42) -> List[str]:
+    """Записывает users синтетических участников с историей за days дней (по сегодня)"""
+    rnd = random.Random(seed)
+    end_date = datetime.now()
+    user_ids = []
+    for index in range(users):
+        user_id = str(100000000 + index)
+        manager.save_user_data(user_id, generate_user(rnd, index, days, end_date))
+        user_ids.append(user_id)
+    manager.flush()
+    return user_ids
+
+def use_data_dir(users_dir: str):
+    """Переключает общий DataManager (его используют боты и рассылки) на каталог замеров"""
+    data_manager.flush()
+    data_manager.users_dir = users_dir
+    data_manager.storage = create_storage(users_dir)
+
+def summarize(samples: List[float]) -> Dict:
+    """Сводка по замерам в миллисекундах"""
+    ordered = sorted(samples)
+    return {
+        'runs': len(ordered),
+        'total_ms': round(sum(ordered) * 1000, 3),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+        'p50_ms': round(ordered[len(ordered) // 2] * 1000, 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3)
+    }
+
+def measure(func: Callable, args_list: List[tuple]) -> Dict:
+    """Время каждого вызова func(*args) из списка аргументов"""
+    samples = []
+    for args in args_list:
+        started = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+async def measure_async(func: Callable, args_list: List[tuple]) -> Dict:
+    samples = []
+    for args in args_list:
+        started = time.perf_counter()
+        await func(*args)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+def bench_data_manager(users_dir: str, user_ids: List[str], samples: int, rnd: random.Random) -> Dict:
+    """Операции DataManager: чтение без кэша и с кэшем, запись, списки и статистика"""
+    results = {}
+    sample_ids = [rnd.choice(user_ids) for _ in range(samples)]
+
+    # Отдельный менеджер с пустым кэшем - чтение с диска
+    cold = DataManager(users_dir=users_dir)
+    results['load_user_data_cold'] = measure(cold.load_user_data, [(user_id,) for user_id in dict.fromkeys(sample_ids)])
+    results['load_user_data_warm'] = measure(cold.load_user_data, [(user_id,) for user_id in sample_ids])
+    results['get_user_stats'] = measure(cold.get_user_stats, [(user_id,) for user_id in sample_ids])
+    results['get_all_users'] = measure(cold.get_all_users, [()] * 3)
+    results['save_meal'] = measure(cold.save_meal, [(user_id, 'bench_photo') for user_id in sample_ids])
+    results['flush'] = measure(cold.flush, [()])
+    results['get_all_user_stats'] = measure(cold.get_all_user_stats, [()])
+    cold.close()
+    return results
+
+async def bench_admin_views(repeat: int) -> Dict:
+    """Экраны админ-бота: без готовых страниц и из кэша"""
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=admin_bot.ADMIN_ID), message=FakeMessage())
+    context = SimpleNamespace()
+    results = {}
+    results['show_general_stats'] = await measure_async(admin_bot.show_general_stats, [(update, context)] * repeat)
+    for name, handler in (('show_users_list', admin_bot.show_users_list),
+                          ('show_daily_progress', admin_bot.show_daily_progress)):
+        samples = []
+        for _ in range(repeat):
+            # Без готовых страниц, списка участников и отчёта о выполнении плана
+            admin_bot.page_cache = PageCache()
+            admin_bot.compliance = ComplianceEngine(data_manager)
+            started = time.perf_counter()
+            await handler(update, context)
+            samples.append(time.perf_counter() - started)
+        results[f"{name}_cold"] = summarize(samples)
+        results[f"{name}_warm"] = await measure_async(handler, [(update, context)] * repeat)
+
+    pages = len(admin_bot.get_roster(include_unreachable=True)) // admin_bot.USERS_PER_PAGE
+    results['render_users_last_page'] = measure(admin_bot.render_page, [('users', pages)] * repeat)
+    return results
+
+async def bench_notifications(bot: FakeBot) -> Dict:
+    """Утренняя рассылка и вечерние напоминания всем участникам через общую очередь"""
+    context = SimpleNamespace(job=None)
+    results = {}
+    for name, job in (('send_morning_message', notifications.send_morning_message),
+                      ('send_evening_reminders', notifications.send_evening_reminders)):
+        sent_before = bot.sent
+        started = time.perf_counter()
+        metrics = await job(context)
+        elapsed = time.perf_counter() - started
+        results[name] = summarize([elapsed])
+        results[name]['messages'] = bot.sent - sent_before
+        results[name]['messages_per_second'] = round((bot.sent - sent_before) / elapsed, 1) if elapsed else None
+        results[name]['outbox'] = metrics
+    return results
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return ''
+
+async def run(args) -> Dict:
+    """Генерирует участников во временном каталоге и выполняет все замеры"""
+    os.environ['DATA_STORAGE'] = args.storage
+    os.environ.pop('DATA_SQLITE_PATH', None)
+    rnd = random.Random(args.seed)
+    with tempfile.TemporaryDirectory(prefix='fit_bench_') as tmp_dir:
+        users_dir = os.path.join(tmp_dir, 'users')
+        use_data_dir(users_dir)
+
+        started = time.perf_counter()
+        user_ids = generate_roster(data_manager, args.users, args.days, args.seed)
+        results = {'generate_roster': summarize([time.perf_counter() - started])}
+
+        results.update(bench_data_manager(users_dir, user_ids, args.samples, rnd))
+        results.update(await bench_admin_views(args.repeat))
+
+        # Очередь сообщений без ограничений частоты и с файлом во временном каталоге
+        outbox_module.BACKLOG_FILE = os.path.join(tmp_dir, 'outbox_{name}.json')
+        outbox.rate = args.rate
+        outbox.per_chat_interval = 0
+        bot = FakeBot(BOT_TOKENS['bot'], latency=args.latency)
+        register_bot(bot)
+        await outbox.start('bench')
+        try:
+            results.update(await bench_notifications(bot))
+        finally:
+            await outbox.stop()
+            data_manager.close()
+
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'storage': args.storage,
+            'users': args.users,
+            'days': args.days,
+            'samples': args.samples,
+            'repeat': args.repeat,
+            'latency': args.latency,
+            'rate': args.rate,
+            'seed': args.seed
+        },
+        'results': results
+    }
+
+def main():
+    """Замеры производительности на синтетических участниках"""
+    parser = argparse.ArgumentParser(description='Замеры DataManager, админ-бота и рассылок на синтетических данных')
+    parser.add_argument('--users', type=int, default=500, help='число участников')
+    parser.add_argument('--days', type=int, default=90, help='дней истории у каждого участника')
+    parser.add_argument('--storage', choices=('json', 'eventlog', 'sqlite'), default='json', help='хранилище')
+    parser.add_argument('--samples', type=int, default=200, help='вызовов на операцию DataManager')
+    parser.add_argument('--repeat', type=int, default=5, help='повторов экранов админ-бота')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка фейкового Bot API, секунд')
+    parser.add_argument('--rate', type=float, default=1e6, help='лимит сообщений в секунду для очереди')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='JSON-файл результатов (по умолчанию data/bench/<время>.json)')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    output = args.output or os.path.join(
+        DEFAULT_OUTPUT_DIR, f"bench_{datetime.now():%Y%m%d_%H%M%S}_{args.storage}_{args.users}x{args.days}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for name, result in report['results'].items():
+        print(f"{name:32} {result['runs']:6} x  mean {result['mean_ms']:10.3f} ms  p95 {result['p95_ms']:10.3f} ms")
+    print(f"Результаты: {output}")
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,16 @@
 import os
 import logging
 from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, ForceReply, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler
-from data_manager import data_manager
+from data_manager import data_manager, local_date
+from telegram_clients import get_bot, close_bots, register_bot
+from outbox import outbox, ADMIN
+from stats_view import stats_cache
+from notifications import setup_notifications, parse_timezone, parse_time, user_notification_settings
+from update_processor import PerChatUpdateProcessor
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -52,6 +58,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     user_data = data_manager.load_user_data(user_id)
     
+    # Пользователь снова с нами - возвращаем его в рассылки
+    if user_data.get('delivery_status'):
+        data_manager.set_delivery_status(user_id, None)
+    
     if not user_data.get('name'):
         await update.message.reply_text(
             'Привет! Как я могу к тебе обращаться? 😊',
@@ -65,30 +75,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
 
-async def notify_admin(context: ContextTypes.DEFAULT_TYPE, message: str, photo_file_id: str = None, reply_markup: InlineKeyboardMarkup = None):
-    """Отправка уведомления админу через админ-бота"""
+async def notify_admin(context: ContextTypes.DEFAULT_TYPE, message: str, photo_file_id: str = None, reply_markup: InlineKeyboardMarkup = None, photo_unique_id: str = None):
+    """Отправка уведомления админу через админ-бота (через общую очередь сообщений)"""
     try:
-        admin_bot = Application.builder().token(ADMIN_BOT_TOKEN).build()
-        async with admin_bot:
-            if photo_file_id:
-                # Получаем файл через основного бота
-                file = await context.bot.get_file(photo_file_id)
-                photo_bytes = await file.download_as_bytearray()
-                
-                # Отправляем фото через админ-бота
-                from io import BytesIO
-                photo_stream = BytesIO(photo_bytes)
-                await admin_bot.bot.send_photo(
-                    chat_id=ADMIN_ID,
-                    photo=photo_stream,
-                    caption=message,
-                    reply_markup=reply_markup
-                )
-            else:
-                await admin_bot.bot.send_message(
-                    chat_id=ADMIN_ID,
-                    text=message
-                )
+        # Фото пересылается из основного бота через админ-бота
+        photo = {'bot': 'bot', 'file_id': photo_file_id, 'unique_id': photo_unique_id} if photo_file_id else None
+        outbox.submit('admin', ADMIN_ID, message, priority=ADMIN, reply_markup=reply_markup, photo=photo)
     except Exception as e:
         logger.error(f"Ошибка при отправке уведомления админу: {e}")
         raise
@@ -99,15 +91,16 @@ async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     
     # Сохраняем имя в базе данных
-    data_manager.save_user_data(user_id, {
-        'user_id': user_id,
-        'name': user_name,
-        'start_date': datetime.now().strftime('%Y-%m-%d'),
-        'weight_history': [],
-        'meals': [],
-        'cardio': [],
-        'strength': []
-    })
+    async with data_manager.user_lock(user_id):
+        data_manager.save_user_data(user_id, {
+            'user_id': user_id,
+            'name': user_name,
+            'start_date': local_date(),
+            'weight_history': [],
+            'meals': [],
+            'cardio': [],
+            'strength': []
+        })
     
     # Уведомление админу о новом пользователе
     admin_message = (
@@ -200,30 +193,33 @@ async def handle_food_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     photo = message.photo[-1]
     
     try:
-        # Сохраняем фото в базе данных
-        data_manager.save_meal(user_id, photo.file_id)
+        # Запись и уведомление админу - по очереди с другими действиями пользователя
+        async with data_manager.user_lock(user_id):
+            # Сохраняем фото в базе данных
+            data_manager.save_meal(user_id, photo.file_id)
         
-        # Создаем клавиатуру для админа
-        admin_keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ Одобрить", callback_data=f"approve_{user_id}_{meal_number}"),
-             InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_{user_id}_{meal_number}")],
-            [InlineKeyboardButton("💬 Комментировать", callback_data=f"comment_{user_id}_{meal_number}")]
-        ])
-
-        # Отправляем фото админу
-        admin_message = (
-            f'🍽 Новый приём пищи\n\n'
-            f'👤 {user_name}\n'
-            f'#️⃣ Приём {meal_number}\n'
-            f'⏰ {datetime.now().strftime("%H:%M")}'
-        )
+            # Создаем клавиатуру для админа
+            admin_keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ Одобрить", callback_data=f"approve_{user_id}_{meal_number}"),
+                 InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_{user_id}_{meal_number}")],
+                [InlineKeyboardButton("💬 Комментировать", callback_data=f"comment_{user_id}_{meal_number}")]
+            ])
+
+            # Отправляем фото админу
+            admin_message = (
+                f'🍽 Новый приём пищи\n\n'
+                f'👤 {user_name}\n'
+                f'#️⃣ Приём {meal_number}\n'
+                f'⏰ {datetime.now().strftime("%H:%M")}'
+            )
         
-        await notify_admin(
-            context=context,
-            message=admin_message,
-            photo_file_id=photo.file_id,
-            reply_markup=admin_keyboard
-        )
+            await notify_admin(
+                context=context,
+                message=admin_message,
+                photo_file_id=photo.file_id,
+                reply_markup=admin_keyboard,
+                photo_unique_id=photo.file_unique_id
+            )
         
         # Отвечаем пользователю
         await message.reply_text(
@@ -281,19 +277,21 @@ async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def handle_cardio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    user_data = data_manager.load_user_data(user_id)
-    user_name = user_data['name']
+    # Запись и уведомление админу - по очереди с другими действиями пользователя
+    async with data_manager.user_lock(user_id):
+        user_data = data_manager.load_user_data(user_id)
+        user_name = user_data['name']
     
-    # Сохраняем кардио в базе данных
-    data_manager.save_cardio(user_id, 30)  # По умолчанию 30 минут
+        # Сохраняем кардио в базе данных
+        data_manager.save_cardio(user_id, 30)  # По умолчанию 30 минут
     
-    # Уведомление админу о кардио
-    admin_message = (
-        f'🏃‍♂️ Кардио выполнено\n\n'
-        f'👤 {user_name}\n'
-        f'⏰ {datetime.now().strftime("%H:%M")}'
-    )
-    await notify_admin(context, admin_message)
+        # Уведомление админу о кардио
+        admin_message = (
+            f'🏃‍♂️ Кардио выполнено\n\n'
+            f'👤 {user_name}\n'
+            f'⏰ {datetime.now().strftime("%H:%M")}'
+        )
+        await notify_admin(context, admin_message)
     
     messages = [
         f'🏃‍♂️ Вау, {user_name}! Кардио засчитано!\n\n'
@@ -315,19 +313,21 @@ async def handle_cardio(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_strength(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    user_data = data_manager.load_user_data(user_id)
-    user_name = user_data['name']
+    # Запись и уведомление админу - по очереди с другими действиями пользователя
+    async with data_manager.user_lock(user_id):
+        user_data = data_manager.load_user_data(user_id)
+        user_name = user_data['name']
     
-    # Сохраняем силовую тренировку в базе данных
-    data_manager.save_strength(user_id, "Силовая тренировка выполнена")
+        # Сохраняем силовую тренировку в базе данных
+        data_manager.save_strength(user_id, "Силовая тренировка выполнена")
     
-    # Уведомление админу о силовой тренировке
-    admin_message = (
-        f'💪 Силовая тренировка выполнена\n\n'
-        f'👤 {user_name}\n'
-        f'⏰ {datetime.now().strftime("%H:%M")}'
-    )
-    await notify_admin(context, admin_message)
+        # Уведомление админу о силовой тренировке
+        admin_message = (
+            f'💪 Силовая тренировка выполнена\n\n'
+            f'👤 {user_name}\n'
+            f'⏰ {datetime.now().strftime("%H:%M")}'
+        )
+        await notify_admin(context, admin_message)
     
     messages = [
         f'💪 Мощно, {user_name}! Силовая тренировка записана!\n\n'
@@ -349,59 +349,8 @@ async def handle_strength(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает статистику пользователя"""
     user_id = str(update.effective_user.id)
-    stats = data_manager.get_user_stats(user_id)
-    
-    # Создаем строку с квадратиками прогресса
-    progress_squares = ""
-    for i in range(90):
-        if i < stats['marathon_progress']:
-            progress_squares += "🟩"  # Зеленый квадрат для пройденных дней
-        else:
-            progress_squares += "⬜️"  # Белый квадрат для оставшихся дней
-        if (i + 1) % 10 == 0:  # Перенос строки каждые 10 квадратиков
-            progress_squares += "\n"
-    
-    message = (
-        f"📊 День {stats['marathon_progress']} из 90\n\n"
-        f"{progress_squares}\n"
-        f"⏳ Осталось: {stats['days_left']} дней\n\n"
-        f"⚖️ Твой путь к прессу:\n"
-    )
-    
-    if stats['current_weight'] is not None:
-        message += (
-            f"Стартовый вес: {stats['start_weight']:.1f} кг\n"
-            f"Текущий вес: {stats['current_weight']:.1f} кг\n"
-            f"Изменение: {stats['weight_diff']:+.1f} кг\n"
-        )
-        
-        if stats['weight_diff'] <= 0:
-            message += "🔥 Жир горит!\n"
-        else:
-            message += "💪 Время поднажать!\n"
-    else:
-        message += "⚖️ Пока нет данных о весе\n"
-    
-    message += "\nСегодняшние подвиги:\n"
-    message += f"🍽 Приёмы пищи: {stats['today_meals']}/5\n"
-    
-    if stats['today_cardio']:
-        message += "🏃‍♂️ Кардио: ✅ 🔥\n"
-    else:
-        message += "🏃‍♂️ Кардио: ❌\n"
-        
-    if stats['today_strength']:
-        message += "💪 Силовая: ✅ 💪\n"
-    else:
-        message += "💪 Силовая: ❌\n"
-    
-    if stats['today_meals'] == 5 and stats['today_cardio'] and stats['today_strength']:
-        message += "\n💪 Ты просто космос! Так держать! 🚀"
-    elif stats['today_meals'] > 0 or stats['today_cardio'] or stats['today_strength']:
-        message += "\n💪 Продолжай в том же духе!"
-    else:
-        message += "\n💪 Давай начнем этот день правильно!"
-    
+    # Сообщение берётся из кэша, пока данные пользователя и дата не изменились
+    message = stats_cache.get(user_id)
     await update.message.reply_text(message)
 
 async def show_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -516,21 +465,22 @@ async def handle_weight(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return WAITING_WEIGHT
             
-        # Сохраняем вес
-        logger.info(f"Сохраняем вес {weight} для пользователя {user_id}")
-        save_result = data_manager.save_weight(user_id, weight)
-        logger.info(f"Результат сохранения: {save_result}")
+        async with data_manager.user_lock(user_id):
+            # Сохраняем вес
+            logger.info(f"Сохраняем вес {weight} для пользователя {user_id}")
+            save_result = data_manager.save_weight(user_id, weight)
+            logger.info(f"Результат сохранения: {save_result}")
         
-        if not save_result:
-            logger.error(f"Ошибка при сохранении веса для пользователя {user_id}")
-            await update.message.reply_text(
-                '❌ Произошла ошибка при сохранении веса. Попробуй позже.',
-                reply_markup=main_keyboard
-            )
-            return ConversationHandler.END
+            if not save_result:
+                logger.error(f"Ошибка при сохранении веса для пользователя {user_id}")
+                await update.message.reply_text(
+                    '❌ Произошла ошибка при сохранении веса. Попробуй позже.',
+                    reply_markup=main_keyboard
+                )
+                return ConversationHandler.END
         
-        # Получаем статистику пользователя
-        stats = data_manager.get_user_stats(user_id)
+            # Получаем статистику пользователя
+            stats = data_manager.get_user_stats(user_id)
         logger.info(f"Получена статистика: {stats}")
         weight_diff = stats.get('weight_diff', 0)
         
@@ -626,10 +576,89 @@ async def handle_trainer_message(update: Update, context: ContextTypes.DEFAULT_T
     
     return ConversationHandler.END
 
-def main():
-    """Запуск бота"""
-    # Создаем приложение
-    application = Application.builder().token(TOKEN).build()
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /timezone: часовой пояс для утренних и вечерних сообщений"""
+    user_id = str(update.effective_user.id)
+    user_data = data_manager.load_user_data(user_id)
+    tz_name, _ = user_notification_settings(user_data)
+    
+    if not context.args:
+        await update.message.reply_text(
+            f'🌍 Твой часовой пояс: {tz_name}\n\n'
+            'Чтобы изменить, отправь, например:\n'
+            '/timezone Europe/Moscow\n'
+            '/timezone UTC+5',
+            reply_markup=main_keyboard
+        )
+        return
+    
+    new_tz = parse_timezone(' '.join(context.args))
+    if not new_tz:
+        await update.message.reply_text(
+            '❌ Не знаю такой часовой пояс. Примеры: Europe/Moscow, Asia/Almaty, UTC+3',
+            reply_markup=main_keyboard
+        )
+        return
+    
+    async with data_manager.user_lock(user_id):
+        data_manager.save_timezone(user_id, new_tz)
+    local_time = datetime.now(ZoneInfo(new_tz)).strftime('%H:%M')
+    await update.message.reply_text(
+        f'✅ Часовой пояс: {new_tz} (сейчас у тебя {local_time})',
+        reply_markup=main_keyboard
+    )
+
+async def set_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /reminders: время утреннего сообщения и вечернего напоминания"""
+    user_id = str(update.effective_user.id)
+    user_data = data_manager.load_user_data(user_id)
+    tz_name, times = user_notification_settings(user_data)
+    
+    new_times = [parse_time(arg) for arg in context.args or []]
+    if len(new_times) != 2 or not all(new_times):
+        await update.message.reply_text(
+            f'⏰ Утреннее сообщение: {times["morning"]}\n'
+            f'🌙 Вечернее напоминание: {times["evening"]}\n'
+            f'🌍 Часовой пояс: {tz_name}\n\n'
+            'Чтобы изменить, отправь время утром и вечером, например:\n'
+            '/reminders 08:30 21:00',
+            reply_markup=main_keyboard
+        )
+        return
+    
+    async with data_manager.user_lock(user_id):
+        data_manager.save_notification_times(user_id, {'morning': new_times[0], 'evening': new_times[1]})
+    await update.message.reply_text(
+        f'✅ Утром напишу в {new_times[0]}, вечером напомню в {new_times[1]} ({tz_name})',
+        reply_markup=main_keyboard
+    )
+
+async def flush_user_data(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически сбрасывает накопленные изменения данных на диск"""
+    data_manager.flush()
+
+async def post_init(application: Application):
+    """Создаёт общий клиент админ-бота и запускает очередь сообщений"""
+    register_bot(application.bot)
+    await get_bot(ADMIN_BOT_TOKEN)
+    await outbox.start('bot')
+
+async def post_shutdown(application: Application):
+    """Останавливает очередь сообщений и закрывает общие клиенты"""
+    await outbox.stop()
+    await close_bots()
+
+def build_application() -> Application:
+    """Создаёт приложение бота со всеми обработчиками и задачами"""
+    # Создаем приложение: разные чаты обрабатываются параллельно, один чат - по порядку
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Добавляем обработчики
     conv_handler = ConversationHandler(
@@ -664,8 +693,21 @@ def main():
     )
     application.add_handler(conv_handler)
     
-    # Запускаем бота
-    application.run_polling()
+    # Настройки времени уведомлений
+    application.add_handler(CommandHandler("timezone", set_timezone))
+    application.add_handler(CommandHandler("reminders", set_reminders))
+    
+    # Сброс кэша данных пользователей на диск
+    application.job_queue.run_repeating(flush_user_data, interval=data_manager.flush_interval)
+    
+    # Утренние и вечерние рассылки
+    setup_notifications(application)
+    
+    return application
+
+def main():
+    """Запуск бота (long polling)"""
+    build_application().run_polling()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,38 @@
+import asyncio
+import time
+from typing import Optional
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и 1 в секунду в один чат
+GLOBAL_RATE = 25  # сообщений в секунду (с запасом)
+PER_CHAT_INTERVAL = 1.0  # секунд между сообщениями в один чат
+MAX_RETRIES = 3
+
+class TokenBucket:
+    """Ограничитель частоты: не больше rate событий в секунду с запасом burst"""
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (например, после RetryAfter)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Ждёт, пока не появится свободный токен"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
@@ -0,0 +1,142 @@
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence
+import pandas as pd
+from data_manager import data_manager, DataManager, local_date
+
+logger = logging.getLogger(__name__)
+
+MIN_MEALS = 3  # Минимум приёмов пищи за день
+WEIGH_IN_WEEKDAY = 4  # Взвешивание - по пятницам
+# Раз в столько секунд отчёт строится заново целиком: изменения из другого
+# процесса счётчики этого процесса не видят. Свои изменения подхватываются сразу
+COMPLIANCE_CACHE_TTL = 60
+# Отчёты за сколько дат держим (в пачке рассылки бывают разные местные даты)
+COMPLIANCE_CACHE_DATES = 4
+
+ACTIVITY_KINDS = ['meals', 'cardio', 'strength', 'weight_history']
+# Колонки отчёта; все целые: флаги - 0/1, остальное - счётчики
+REPORT_COLUMNS = [
+    'meals', 'cardio', 'strength',  # активности за день
+    'meals_ok', 'workout', 'day_done',  # 3+ приёма пищи, кардио или силовая, и то и другое
+    'weighed_week',  # взвешивался с начала недели
+    'active_days', 'complete_days', 'cardio_days', 'strength_days'  # дни недели до даты включительно
+]
+
+def week_start(date: str) -> str:
+    """Понедельник недели, в которую попадает дата"""
+    day = datetime.strptime(date, '%Y-%m-%d')
+    return (day - timedelta(days=day.weekday())).strftime('%Y-%m-%d')
+
+def is_weigh_in_day(date: str) -> bool:
+    return datetime.strptime(date, '%Y-%m-%d').weekday() == WEIGH_IN_WEEKDAY
+
+def build_activity_frame(counts: Dict[str, List]) -> pd.DataFrame:
+    """Счётчики по дням: строка на (участник, день), колонка на вид активности"""
+    frame = pd.DataFrame(counts, columns=['user_id', 'date', 'kind', 'count'])
+    if frame.empty:
+        index = pd.MultiIndex.from_arrays([[], []], names=['user_id', 'date'])
+        return pd.DataFrame(0, index=index, columns=ACTIVITY_KINDS)
+    return (
+        frame.groupby(['user_id', 'date', 'kind'])['count'].sum()
+        .unstack('kind', fill_value=0)
+        .reindex(columns=ACTIVITY_KINDS, fill_value=0)
+    )
+
+def compute_compliance(days: pd.DataFrame, user_ids: Sequence[str], date: str) -> pd.DataFrame:
+    """Выполнение плана участниками за день и за неделю до этого дня
+
+    days - результат build_activity_frame за дни с понедельника по date.
+    """
+    workout = (days['cardio'] > 0) | (days['strength'] > 0)
+    flags = pd.DataFrame({
+        'active': (days[['meals', 'cardio', 'strength']] > 0).any(axis=1),
+        'complete': (days['meals'] >= MIN_MEALS) & workout,
+        'cardio': days['cardio'] > 0,
+        'strength': days['strength'] > 0,
+        'weighed': days['weight_history'] > 0
+    }, index=days.index).astype(int)
+    week = flags.groupby(level='user_id').sum()
+    today = days[days.index.get_level_values('date') == date].droplevel('date')
+
+    index = pd.Index(user_ids, name='user_id')
+    today = today.reindex(index, fill_value=0)
+    week = week.reindex(index, fill_value=0)
+    report = pd.DataFrame({
+        'meals': today['meals'],
+        'cardio': today['cardio'],
+        'strength': today['strength'],
+        'meals_ok': (today['meals'] >= MIN_MEALS).astype(int),
+        'workout': ((today['cardio'] > 0) | (today['strength'] > 0)).astype(int),
+        'day_done': ((today['meals'] >= MIN_MEALS) & (today['cardio'] > 0) & (today['strength'] > 0)).astype(int),
+        'weighed_week': (week['weighed'] > 0).astype(int),
+        'active_days': week['active'],
+        'complete_days': week['complete'],
+        'cardio_days': week['cardio'],
+        'strength_days': week['strength']
+    }, index=index)
+    return report[REPORT_COLUMNS].astype(int)
+
+class ComplianceEngine:
+    """Отчёт о выполнении плана всеми участниками, общий для напоминаний и админки
+
+    Активности с начала недели читаются из хранилища одним проходом в таблицу,
+    всё остальное считается группировками pandas. Отчёт за дату строится целиком
+    раз в COMPLIANCE_CACHE_TTL секунд; после изменений в этом процессе
+    пересчитываются только строки изменившихся участников.
+    """
+
+    def __init__(self, manager: DataManager, ttl: float = COMPLIANCE_CACHE_TTL,
+                 max_dates: int = COMPLIANCE_CACHE_DATES):
+        self.manager = manager
+        self.ttl = ttl
+        self.max_dates = max_dates
+        # дата -> [время построения, отчёт, участники с изменениями после построения]
+        self._reports: OrderedDict = OrderedDict()
+        manager.add_listener(self._invalidate)
+
+    def _invalidate(self, user_id: str):
+        for entry in list(self._reports.values()):
+            entry[2].add(user_id)
+
+    def _build(self, date: str, user_ids: Optional[List[str]] = None) -> pd.DataFrame:
+        """Отчёт за день по участникам (по умолчанию - по всем с именами)"""
+        roster = user_ids
+        if roster is None:
+            roster = [user['user_id'] for user in self.manager.get_all_users(include_unreachable=True)]
+        try:
+            days = build_activity_frame(self.manager.get_activity_counts(week_start(date), date, user_ids))
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке активностей для отчёта: {e}")
+            days = build_activity_frame({})
+        return compute_compliance(days, roster, date)
+
+    def report(self, date: Optional[str] = None) -> pd.DataFrame:
+        """Отчёт за день (по умолчанию - за сегодня) по всем участникам с именами"""
+        date = date or local_date()
+        entry = self._reports.get(date)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            # Изменения во время построения попадут в следующий пересчёт
+            entry = [time.monotonic(), None, set()]
+            self._reports[date] = entry
+            entry[1] = self._build(date)
+            while len(self._reports) > self.max_dates:
+                self._reports.popitem(last=False)
+        elif entry[2]:
+            stale, entry[2] = entry[2], set()
+            changed = self._build(date, sorted(stale))
+            entry[1] = pd.concat([entry[1].drop(changed.index, errors='ignore'), changed])
+        self._reports.move_to_end(date)
+        return entry[1]
+
+    def rows(self, user_ids: Sequence[str], date: Optional[str] = None) -> Dict[str, Dict]:
+        """Строки отчёта для участников: user_id -> {колонка: значение}
+
+        Участник, которого ещё нет в отчёте, получает нули.
+        """
+        return self.report(date).reindex(pd.Index(user_ids, name='user_id'), fill_value=0).to_dict('index')
+
+# Общий отчёт процесса
+compliance = ComplianceEngine(data_manager)
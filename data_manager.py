@@ -1,14 +1,183 @@
-import json
 import os
+import time
+import atexit
+import copy
+import asyncio
+import threading
+import weakref
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from tzlocal import get_localzone_name
+from storage import JsonStorage, create_storage
+
+# Загрузка переменных окружения (выбор хранилища)
+load_dotenv()
+
+# Параметры кэша пользовательских данных
+CACHE_MAX_USERS = 1024  # Сколько записей пользователей держим в памяти
+FLUSH_INTERVAL = 10  # Не дольше стольких секунд изменения живут только в памяти
+FLUSH_MAX_DIRTY = 50  # Сбрасываем на диск, когда накопилось столько изменённых записей
+# Процессов для сводной статистики (0 или 1 - считать в текущем процессе)
+STATS_PROCESSES = int(os.getenv('STATS_PROCESSES', '0'))
+# Часовой пояс пользователей, которые не выбрали свой (по умолчанию - пояс сервера)
+DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE') or get_localzone_name()
+
+def local_date(timezone: Optional[str] = None) -> str:
+    """Сегодняшняя дата (YYYY-MM-DD) в часовом поясе, по умолчанию - в DEFAULT_TIMEZONE"""
+    try:
+        return datetime.now(ZoneInfo(timezone or DEFAULT_TIMEZONE)).strftime('%Y-%m-%d')
+    except (ZoneInfoNotFoundError, ValueError):
+        return datetime.now().strftime('%Y-%m-%d')
+
+ACTIVITY_FIELDS = ('weight_history', 'meals', 'cardio', 'strength')
+
+def snapshot_user_data(data: Dict) -> Dict:
+    """Состояние записи на момент чтения с диска: поля и длины списков активностей"""
+    return {
+        key: len(value) if key in ACTIVITY_FIELDS else copy.deepcopy(value)
+        for key, value in data.items() if key != 'daily'
+    }
+
+def merge_user_data(local: Dict, stored: Dict, base: Dict) -> Dict:
+    """Слияние записи из кэша с записью, которую изменил другой процесс
+
+    base - снимок записи на момент чтения (snapshot_user_data). Из кэша берутся
+    только поля, изменённые в этом процессе, и добавленные активности; остальное -
+    как на диске.
+    """
+    merged = dict(stored)
+    for key, value in local.items():
+        if key == 'daily':
+            continue
+        if key in ACTIVITY_FIELDS:
+            merged[key] = list(stored.get(key, [])) + value[base.get(key, 0):]
+        elif key not in base or base[key] != value:
+            merged[key] = value
+    for key in base:
+        if key not in local and key not in ACTIVITY_FIELDS:
+            merged.pop(key, None)
+    merged['daily'] = build_daily_counters(merged)
+    return merged
+
+def _empty_day() -> Dict:
+    """Пустые счётчики активности за день"""
+    return {'meals': 0, 'cardio': 0, 'cardio_minutes': 0, 'strength': 0, 'weight': None}
+
+def add_to_daily(daily: Dict, field: str, entry: Dict):
+    """Учитывает запись активности в счётчиках по дням"""
+    day = daily.setdefault(entry['date'][:10], _empty_day())
+    if field == 'meals':
+        day['meals'] += 1
+    elif field == 'cardio':
+        day['cardio'] += 1
+        day['cardio_minutes'] += entry.get('duration') or 0
+    elif field == 'strength':
+        day['strength'] += 1
+    elif field == 'weight_history':
+        day['weight'] = entry['weight']
+
+def build_daily_counters(user_data: Dict) -> Dict:
+    """Строит счётчики по дням из полной истории активностей"""
+    daily: Dict[str, Dict] = {}
+    for field in ('meals', 'cardio', 'strength', 'weight_history'):
+        for entry in user_data.get(field, []):
+            add_to_daily(daily, field, entry)
+    return daily
+
+def compute_user_stats(user_data: Dict, date: Optional[str] = None) -> Dict:
+    """Статистика пользователя за день по его записи"""
+    # Получаем дату начала марафона
+    start_date = datetime.strptime(user_data['start_date'], '%Y-%m-%d')
+    today = datetime.strptime(date, '%Y-%m-%d') if date else datetime.now()
+    
+    # Считаем прогресс марафона (день 1 = первый день)
+    days_passed = (today - start_date).days + 1  # +1 потому что первый день тоже считается
+    marathon_progress = min(days_passed, 90)  # Не больше 90 дней
+    days_left = max(90 - days_passed, 0)  # Не меньше 0 дней
+    
+    # Получаем текущий вес и разницу
+    weight_history = user_data.get('weight_history', [])
+    current_weight = weight_history[-1]['weight'] if weight_history else None
+    start_weight = weight_history[0]['weight'] if weight_history else None
+    weight_diff = current_weight - start_weight if current_weight and start_weight else 0
+    
+    # Активности за день берём из счётчиков по дням
+    if 'daily' not in user_data:
+        user_data['daily'] = build_daily_counters(user_data)
+    day = user_data['daily'].get(today.strftime('%Y-%m-%d')) or _empty_day()
+    
+    return {
+        'marathon_progress': marathon_progress,
+        'days_left': days_left,
+        'current_weight': current_weight,
+        'start_weight': start_weight,
+        'weight_diff': weight_diff,
+        'today_meals': day['meals'],
+        'today_cardio': day['cardio'] > 0,
+        'today_cardio_minutes': day['cardio_minutes'],
+        'today_strength': day['strength'] > 0,
+        'today_weight': day['weight']
+    }
+
+def summarize_user(user_id: str, user_data: Optional[Dict], date: str) -> Optional[Dict]:
+    """Сводка по участнику для админских отчётов (None - участник без имени)"""
+    if not user_data or not user_data.get('name'):
+        return None
+    return {
+        'user_id': user_id,
+        'name': user_data['name'],
+        'start_date': user_data['start_date'],
+        'delivery_status': user_data.get('delivery_status'),
+        'stats': compute_user_stats(user_data, date),
+        'totals': {field: len(user_data.get(field, [])) for field in ('meals', 'cardio', 'strength')}
+    }
+
+# Хранилище процесса-воркера сводной статистики
+_worker_storage = None
+
+def _init_stats_worker(storage_spec):
+    """Открывает хранилище в процессе-воркере"""
+    global _worker_storage
+    storage_class, args = storage_spec
+    _worker_storage = storage_class(*args)
+
+def _load_user_summary(user_id: str, date: str) -> Optional[Dict]:
+    """Читает запись и считает сводку в процессе-воркере"""
+    return summarize_user(user_id, _worker_storage.load(user_id), date)
 
 class DataManager:
-    def __init__(self):
+    def __init__(self, users_dir: Optional[str] = None, storage: Optional[JsonStorage] = None,
+                 cache_size: int = CACHE_MAX_USERS, flush_interval: float = FLUSH_INTERVAL,
+                 flush_max_dirty: int = FLUSH_MAX_DIRTY):
         """Инициализация менеджера данных"""
-        self.users_dir = os.path.join(os.path.dirname(__file__), 'data', 'users')
-        os.makedirs(self.users_dir, exist_ok=True)
+        self.users_dir = users_dir or os.path.join(os.path.dirname(__file__), 'data', 'users')
+        self.storage = storage or create_storage(self.users_dir)
+        
+        # LRU-кэш записей пользователей: user_id -> (данные, версия на диске)
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.flush_max_dirty = flush_max_dirty
+        self._cache: OrderedDict = OrderedDict()
+        # Изменённые записи: user_id -> добавленные активности или None (переписать целиком)
+        self._dirty: Dict[str, Optional[List[Tuple[str, Dict]]]] = {}
+        # Снимки записей на момент чтения: по ним изменения сливаются с чужими при сбросе
+        self._bases: Dict[str, Dict] = {}
+        self._last_flush = time.monotonic()
+        self._stats_pool: Optional[ProcessPoolExecutor] = None
+        # Кэш и список изменений трогают обработчики, задачи по таймеру и потоки
+        self._lock = threading.RLock()
+        # Замки пользователей для обработчиков: живут, пока кто-то их держит
+        self._user_locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+        # Счётчики изменений записей в этом процессе и подписчики на изменения (кэши отображения)
+        self._versions: Dict[str, int] = {}
+        self._version = 0  # общий счётчик изменений всех записей
+        self._listeners: List[Callable[[str], None]] = []
+        atexit.register(self.close)
         
         # Настройка логирования
         self.logger = logging.getLogger(__name__)
@@ -19,143 +188,444 @@ class DataManager:
             self.logger.addHandler(handler)
             self.logger.setLevel(logging.INFO)
 
+    def user_lock(self, user_id: str) -> asyncio.Lock:
+        """Замок пользователя: обработчики одного пользователя меняют его данные по очереди
+
+        Использование: async with data_manager.user_lock(user_id): ...
+        """
+        with self._lock:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = asyncio.Lock()
+                self._user_locks[user_id] = lock
+            return lock
+
+    def add_listener(self, callback: Callable[[str], None]):
+        """Подписывает callback(user_id) на изменения записей пользователей"""
+        self._listeners.append(callback)
+
+    def data_version(self, user_id: Optional[str] = None) -> int:
+        """Номер версии записи пользователя (без user_id - всех записей)
+
+        Растёт при каждом изменении, без обращения к диску.
+        """
+        if user_id is None:
+            return self._version
+        return self._versions.get(user_id, 0)
+
+    def _touch(self, user_id: str):
+        """Отмечает изменение записи и оповещает подписчиков"""
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+        self._version += 1
+        for callback in self._listeners:
+            try:
+                callback(user_id)
+            except Exception as e:
+                self.logger.error(f"Ошибка в подписчике на изменения данных: {e}")
+
     def get_user_data_file(self, user_id: str) -> str:
         """Возвращает путь к файлу с данными пользователя"""
-        return os.path.join(self.users_dir, f"{user_id}.json")
+        return self.storage.get_user_data_file(user_id)
+
+    def _empty_user_data(self, user_id: str) -> Dict:
+        """Возвращает пустую запись пользователя"""
+        return {
+            'user_id': user_id,
+            'name': None,
+            'start_date': None,
+            'weight_history': [],
+            'meals': [],
+            'cardio': [],
+            'strength': [],
+            'daily': {}
+        }
+
+    def _cache_get(self, user_id: str) -> Optional[Dict]:
+        """Достаёт запись из кэша, если она не устарела"""
+        entry = self._cache.get(user_id)
+        if entry is None:
+            return None
+        data, version = entry
+        # Чистую запись сверяем с диском: данные мог изменить другой процесс
+        if user_id not in self._dirty and self.storage.version(user_id) != version:
+            del self._cache[user_id]
+            self._bases.pop(user_id, None)
+            # Запись изменил другой процесс
+            self._touch(user_id)
+            return None
+        self._cache.move_to_end(user_id)
+        return data
+
+    def _cache_put(self, user_id: str, data: Dict, version):
+        """Кладёт запись в кэш и вытесняет самые старые"""
+        self._cache[user_id] = (data, version)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            old_id = next(iter(self._cache))
+            # Не теряем изменения: если записать не удалось, запись остаётся в кэше
+            if old_id in self._dirty and not self._write_user_data(old_id):
+                break
+            self._cache.pop(old_id)
+            self._bases.pop(old_id, None)
+
+    def _write_user_data(self, user_id: str) -> bool:
+        """Записывает закэшированную запись пользователя в хранилище
+
+        Если с момента чтения запись на диске изменил другой процесс (статус
+        доставки, правки тренера), изменения этого процесса сливаются с ней,
+        а не затирают её.
+        """
+        data, version = self._cache[user_id]
+        try:
+            if self.storage.version(user_id) != version:
+                stored = self.storage.load(user_id)
+                if stored is not None:
+                    self.logger.info(f"Запись пользователя {user_id} изменена другим процессом, объединяем")
+                    data = merge_user_data(data, stored, self._bases.get(user_id, {}))
+                    self._touch(user_id)
+            self.storage.save(user_id, data, appended=self._dirty.get(user_id))
+            self._cache[user_id] = (data, self.storage.version(user_id))
+            self._bases[user_id] = snapshot_user_data(data)
+            self._dirty.pop(user_id, None)
+            return True
+        except Exception as e:
+            self.logger.error(f"Ошибка при сохранении данных пользователя {user_id}: {e}")
+            return False
+
+    def _maybe_flush(self) -> bool:
+        """Сбрасывает изменения, если пора по таймеру или по их количеству"""
+        if (len(self._dirty) >= self.flush_max_dirty
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            return self.flush()
+        return True
+
+    def flush(self) -> bool:
+        """Сбрасывает в хранилище все изменённые записи"""
+        ok = True
+        with self._lock:
+            for user_id in list(self._dirty):
+                ok = self._write_user_data(user_id) and ok
+            self._last_flush = time.monotonic()
+        return ok
+
+    def close(self):
+        """Сбрасывает изменения и закрывает хранилище"""
+        self.flush()
+        if self._stats_pool is not None:
+            self._stats_pool.shutdown()
+            self._stats_pool = None
+        self.storage.close()
 
     def load_user_data(self, user_id: str) -> Dict:
         """Загружает данные пользователя"""
         try:
-            file_path = self.get_user_data_file(user_id)
-            if not os.path.exists(file_path):
-                return {
-                    'user_id': user_id,
-                    'name': None,
-                    'start_date': None,
-                    'weight_history': [],
-                    'meals': [],
-                    'cardio': [],
-                    'strength': []
-                }
-            
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with self._lock:
+                data = self._cache_get(user_id)
+                if data is not None:
+                    return data
+                
+                version = self.storage.version(user_id)
+                data = self.storage.load(user_id)
+                if data is None:
+                    return self._empty_user_data(user_id)
+                if 'daily' not in data:
+                    # Старые записи без счётчиков: достраиваем в памяти, на диск
+                    # они попадут со следующим сохранением
+                    data['daily'] = build_daily_counters(data)
+                self._cache_put(user_id, data, version)
+                self._bases[user_id] = snapshot_user_data(data)
+                return data
         except Exception as e:
             self.logger.error(f"Ошибка при загрузке данных пользователя {user_id}: {e}")
-            return {
-                'user_id': user_id,
-                'name': None,
-                'start_date': None,
-                'weight_history': [],
-                'meals': [],
-                'cardio': [],
-                'strength': []
-            }
+            return self._empty_user_data(user_id)
 
     def save_user_data(self, user_id: str, data: Dict) -> bool:
-        """Сохраняет данные пользователя"""
+        """Сохраняет данные пользователя
+        
+        Запись попадает в кэш и помечается изменённой, в хранилище изменения
+        уходят пачкой: по таймеру, по числу изменённых записей или при flush().
+        """
         try:
-            # Создаем директорию, если её нет
-            os.makedirs(self.users_dir, exist_ok=True)
-            
-            # Путь к файлу пользователя
-            file_path = os.path.join(self.users_dir, f"{user_id}.json")
-            
-            # Сохраняем данные в файл
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            return True
+            if 'daily' not in data:
+                data['daily'] = build_daily_counters(data)
+            with self._lock:
+                entry = self._cache.get(user_id)
+                self._cache_put(user_id, data, entry[1] if entry else None)
+                self._dirty[user_id] = None
+                self._touch(user_id)
+                return self._maybe_flush()
         except Exception as e:
             self.logger.error(f"Ошибка при сохранении данных пользователя {user_id}: {e}")
             return False
 
-    def get_all_users(self) -> List[Dict]:
-        """Возвращает список всех пользователей"""
+    def _append_entry(self, user_id: str, field: str, entry: Dict) -> bool:
+        """Добавляет запись активности; хранилище может дописать её в журнал"""
+        with self._lock:
+            data = self.load_user_data(user_id)
+            data.setdefault(field, []).append(entry)
+            add_to_daily(data.setdefault('daily', {}), field, entry)
+            cached = self._cache.get(user_id)
+            self._cache_put(user_id, data, cached[1] if cached else None)
+            if user_id not in self._dirty:
+                self._dirty[user_id] = [(field, entry)]
+            elif self._dirty[user_id] is not None:
+                self._dirty[user_id].append((field, entry))
+            self._touch(user_id)
+            return self._maybe_flush()
+
+    def _user_ids(self) -> List[str]:
+        """ID всех пользователей, включая ещё не сброшенных в хранилище"""
+        user_ids = self.storage.list_user_ids()
+        known = set(user_ids)
+        with self._lock:
+            return user_ids + [user_id for user_id in self._dirty if user_id not in known]
+
+    def get_all_users(self, include_unreachable: bool = False) -> List[Dict]:
+        """Возвращает список всех пользователей
+        
+        Пользователи, заблокировавшие бота или недоступные, по умолчанию пропускаются.
+        """
         users = []
         try:
-            for filename in os.listdir(self.users_dir):
-                if filename.endswith('.json'):
-                    user_id = filename[:-5]  # Убираем .json
-                    user_data = self.load_user_data(user_id)
-                    if user_data['name']:  # Добавляем только пользователей с именами
-                        users.append({
-                            'user_id': user_id,
-                            'name': user_data['name'],
-                            'start_date': user_data['start_date']
-                        })
+            if self.storage.indexed:
+                self.flush()
+                return self.storage.list_users(include_unreachable)
+            for user_id in self._user_ids():
+                user_data = self.load_user_data(user_id)
+                if not user_data['name']:  # Добавляем только пользователей с именами
+                    continue
+                if user_data.get('delivery_status') and not include_unreachable:
+                    continue
+                users.append({
+                    'user_id': user_id,
+                    'name': user_data['name'],
+                    'start_date': user_data['start_date'],
+                    'delivery_status': user_data.get('delivery_status')
+                })
         except Exception as e:
             self.logger.error(f"Ошибка при получении списка пользователей: {e}")
         return users
 
-    def get_user_stats(self, user_id: str) -> dict:
-        """Получение статистики пользователя"""
+    def set_delivery_status(self, user_id: str, status: Optional[str]) -> bool:
+        """Помечает чат пользователя недоступным ('blocked', 'unreachable') или снова активным (None)"""
+        try:
+            with self._lock:
+                data = self.load_user_data(user_id)
+                if data.get('delivery_status') == status:
+                    return True
+                if status:
+                    data['delivery_status'] = status
+                    data['delivery_status_date'] = datetime.now().strftime('%Y-%m-%d')
+                else:
+                    data.pop('delivery_status', None)
+                    data.pop('delivery_status_date', None)
+                self.logger.info(f"Статус доставки пользователя {user_id}: {status or 'active'}")
+                return self.save_user_data(user_id, data)
+        except Exception as e:
+            self.logger.error(f"Ошибка при обновлении статуса доставки пользователя {user_id}: {e}")
+            return False
+
+    def get_day_activity(self, date: Optional[str] = None) -> Dict[str, Dict]:
+        """Счётчики всех участников за день: user_id -> {meals, cardio, cardio_minutes, strength, weight}"""
+        date = date or local_date()
+        if self.storage.indexed:
+            self.flush()
+            return self.storage.day_activity(date)
+        
+        activity = {}
+        for user_id in self._user_ids():
+            day = self.load_user_data(user_id).get('daily', {}).get(date)
+            if day:
+                activity[user_id] = dict(day)
+        return activity
+
+    def get_activity_counts(self, date_from: str, date_to: str,
+                            user_ids: Optional[List[str]] = None) -> Dict[str, List]:
+        """Число активностей за период (даты включаются) колонками user_id, date, kind, count
+
+        kind - поле записи: meals, cardio, strength или weight_history.
+        user_ids - только эти участники (по умолчанию все).
+        """
+        if self.storage.indexed:
+            self.flush()
+            return self.storage.activity_counts(date_from, date_to, user_ids)
+        
+        start = datetime.strptime(date_from, '%Y-%m-%d')
+        days = [
+            (start + timedelta(days=i)).strftime('%Y-%m-%d')
+            for i in range((datetime.strptime(date_to, '%Y-%m-%d') - start).days + 1)
+        ]
+        columns: Dict[str, List] = {'user_id': [], 'date': [], 'kind': [], 'count': []}
+        for user_id in (self._user_ids() if user_ids is None else user_ids):
+            daily = self.load_user_data(user_id).get('daily', {})
+            for date in days:
+                day = daily.get(date)
+                if not day:
+                    continue
+                for kind, count in (('meals', day['meals']), ('cardio', day['cardio']),
+                                    ('strength', day['strength']),
+                                    ('weight_history', int(day['weight'] is not None))):
+                    if count:
+                        columns['user_id'].append(user_id)
+                        columns['date'].append(date)
+                        columns['kind'].append(kind)
+                        columns['count'].append(count)
+        return columns
+
+    def get_activity_totals(self) -> Dict[str, Dict]:
+        """Число активностей за всё время: user_id -> {meals, cardio, strength}"""
+        if self.storage.indexed:
+            self.flush()
+            return self.storage.activity_totals()
+        
+        totals = {}
+        for user_id in self._user_ids():
+            user_data = self.load_user_data(user_id)
+            totals[user_id] = {
+                field: len(user_data.get(field, []))
+                for field in ('meals', 'cardio', 'strength')
+            }
+        return totals
+
+    def user_local_date(self, user_id: str) -> str:
+        """Сегодняшняя дата в часовом поясе пользователя: ею помечаются его записи"""
+        return local_date(self.load_user_data(user_id).get('timezone'))
+
+    def get_user_stats(self, user_id: str, date: Optional[str] = None) -> dict:
+        """Получение статистики пользователя за день (по умолчанию - за его сегодня)"""
         user_data = self.load_user_data(user_id)
         if not user_data:
             return {}
-            
-        # Получаем дату начала марафона
-        start_date = datetime.strptime(user_data['start_date'], '%Y-%m-%d')
-        today = datetime.now()
-        
-        # Считаем прогресс марафона (день 1 = первый день)
-        days_passed = (today - start_date).days + 1  # +1 потому что первый день тоже считается
-        marathon_progress = min(days_passed, 90)  # Не больше 90 дней
-        days_left = max(90 - days_passed, 0)  # Не меньше 0 дней
+        return compute_user_stats(user_data, date or local_date(user_data.get('timezone')))
+
+    def _get_stats_pool(self, processes: int) -> ProcessPoolExecutor:
+        """Пул процессов для сводной статистики (создаётся один раз)"""
+        if self._stats_pool is None:
+            self._stats_pool = ProcessPoolExecutor(
+                max_workers=processes,
+                initializer=_init_stats_worker,
+                initargs=(self.storage.spec(),)
+            )
+        return self._stats_pool
+
+    def _indexed_summaries(self, date: str) -> List[Dict]:
+        """Сводки участников из агрегатов индексированного хранилища"""
+        self.flush()
+        activity = self.get_day_activity(date)
+        totals = self.get_activity_totals()
+        weights = self.storage.weight_bounds()
+        summaries = []
+        for user in self.storage.list_users(include_unreachable=True):
+            user_id = user['user_id']
+            # Для статистики за день достаточно старта, первого и последнего веса и счётчиков дня
+            record = {
+                'start_date': user['start_date'],
+                'weight_history': [{'weight': weight} for weight in weights.get(user_id, ())],
+                'daily': {date: activity[user_id]} if user_id in activity else {}
+            }
+            summaries.append({
+                'user_id': user_id,
+                'name': user['name'],
+                'start_date': user['start_date'],
+                'delivery_status': user['delivery_status'],
+                'stats': compute_user_stats(record, date),
+                'totals': totals.get(user_id, {'meals': 0, 'cardio': 0, 'strength': 0})
+            })
+        return summaries
+
+    def get_all_user_stats(self, date: Optional[str] = None, include_unreachable: bool = False,
+                           processes: Optional[int] = None) -> Dict:
+        """Статистика всех участников и общие итоги за один проход
         
-        # Получаем текущий вес и разницу
-        weight_history = user_data.get('weight_history', [])
-        current_weight = weight_history[-1]['weight'] if weight_history else None
-        start_weight = weight_history[0]['weight'] if weight_history else None
-        weight_diff = current_weight - start_weight if current_weight and start_weight else 0
+        Каждая запись читается один раз. С processes > 1 записи читаются и
+        считаются в пуле процессов - это окупается на больших списках участников.
+        В SQLite итоги считаются запросами с GROUP BY, без чтения историй.
+        """
+        date = date or local_date()
+        processes = STATS_PROCESSES if processes is None else processes
+        summaries = []
+        try:
+            if self.storage.indexed:
+                # Итоги считает база группировками, полные истории не читаются
+                summaries = self._indexed_summaries(date)
+            elif processes > 1:
+                # Воркеры читают хранилище сами - сначала сбрасываем кэш
+                self.flush()
+                user_ids = self.storage.list_user_ids()
+                pool = self._get_stats_pool(processes)
+                chunksize = max(1, len(user_ids) // (processes * 4))
+                summaries = pool.map(_load_user_summary, user_ids, [date] * len(user_ids), chunksize=chunksize)
+            else:
+                summaries = (
+                    summarize_user(user_id, self.load_user_data(user_id), date)
+                    for user_id in self._user_ids()
+                )
+            summaries = [
+                summary for summary in summaries
+                if summary and (include_unreachable or not summary['delivery_status'])
+            ]
+        except Exception as e:
+            self.logger.error(f"Ошибка при подсчёте статистики участников: {e}")
         
-        # Проверяем активности за сегодня
-        today_str = today.strftime('%Y-%m-%d')
-        today_meals = len([m for m in user_data.get('meals', []) if m['date'].startswith(today_str)])
-        today_cardio = any(c['date'].startswith(today_str) for c in user_data.get('cardio', []))
-        today_strength = any(s['date'].startswith(today_str) for s in user_data.get('strength', []))
+        totals = {'users': len(summaries), 'active': 0, 'meals': 0, 'cardio': 0,
+                  'strength': 0, 'losing_weight': 0}
+        for summary in summaries:
+            stats = summary['stats']
+            if stats['today_meals'] > 0 or stats['today_cardio'] or stats['today_strength']:
+                totals['active'] += 1
+            for field in ('meals', 'cardio', 'strength'):
+                totals[field] += summary['totals'][field]
+            if stats['weight_diff'] < 0:
+                totals['losing_weight'] += 1
         
-        return {
-            'marathon_progress': marathon_progress,
-            'days_left': days_left,
-            'current_weight': current_weight,
-            'start_weight': start_weight,
-            'weight_diff': weight_diff,
-            'today_meals': today_meals,
-            'today_cardio': today_cardio,
-            'today_strength': today_strength
-        }
+        return {'date': date, 'users': summaries, 'totals': totals}
 
     def save_name(self, user_id: str, name: str) -> bool:
         """Сохраняет имя пользователя"""
         try:
             if not name or len(name) > 50:
                 return False
-            data = self.load_user_data(user_id)
-            data['name'] = name
-            return self.save_user_data(user_id, data)
+            with self._lock:
+                data = self.load_user_data(user_id)
+                data['name'] = name
+                return self.save_user_data(user_id, data)
         except Exception as e:
             self.logger.error(f"Ошибка при сохранении имени пользователя {user_id}: {e}")
             return False
 
+    def save_timezone(self, user_id: str, timezone: str) -> bool:
+        """Сохраняет часовой пояс пользователя (имя IANA, например Europe/Moscow)"""
+        try:
+            with self._lock:
+                data = self.load_user_data(user_id)
+                data['timezone'] = timezone
+                return self.save_user_data(user_id, data)
+        except Exception as e:
+            self.logger.error(f"Ошибка при сохранении часового пояса пользователя {user_id}: {e}")
+            return False
+
+    def save_notification_times(self, user_id: str, times: Dict[str, str]) -> bool:
+        """Сохраняет время уведомлений пользователя: {'morning': 'ЧЧ:ММ', 'evening': 'ЧЧ:ММ'}"""
+        try:
+            with self._lock:
+                data = self.load_user_data(user_id)
+                data.setdefault('notification_times', {}).update(times)
+                return self.save_user_data(user_id, data)
+        except Exception as e:
+            self.logger.error(f"Ошибка при сохранении времени уведомлений пользователя {user_id}: {e}")
+            return False
+
     def save_weight(self, user_id: str, weight: float) -> bool:
         """Сохраняет вес пользователя"""
         try:
             self.logger.info(f"Начало сохранения веса {weight} для пользователя {user_id}")
-            user_data = self.load_user_data(user_id)
-            self.logger.info(f"Загружены данные пользователя: {user_data}")
-            
-            if 'weight_history' not in user_data:
-                self.logger.info("Создаем новую историю веса")
-                user_data['weight_history'] = []
             
             weight_entry = {
                 'weight': weight,
-                'date': datetime.now().strftime('%Y-%m-%d')
+                'date': self.user_local_date(user_id)
             }
             self.logger.info(f"Добавляем запись о весе: {weight_entry}")
-            user_data['weight_history'].append(weight_entry)
-            
-            save_result = self.save_user_data(user_id, user_data)
+            save_result = self._append_entry(user_id, 'weight_history', weight_entry)
             self.logger.info(f"Результат сохранения: {save_result}")
             return save_result
         except Exception as e:
@@ -167,12 +637,10 @@ class DataManager:
         try:
             if not photo_id:
                 return False
-            data = self.load_user_data(user_id)
-            data['meals'].append({
-                'date': datetime.now().strftime('%Y-%m-%d'),
+            return self._append_entry(user_id, 'meals', {
+                'date': self.user_local_date(user_id),
                 'photo_id': photo_id
             })
-            return self.save_user_data(user_id, data)
         except Exception as e:
             self.logger.error(f"Ошибка при сохранении приема пищи пользователя {user_id}: {e}")
             return False
@@ -182,12 +650,10 @@ class DataManager:
         try:
             if not isinstance(duration, int) or duration <= 0 or duration > 300:
                 return False
-            data = self.load_user_data(user_id)
-            data['cardio'].append({
-                'date': datetime.now().strftime('%Y-%m-%d'),
+            return self._append_entry(user_id, 'cardio', {
+                'date': self.user_local_date(user_id),
                 'duration': duration
             })
-            return self.save_user_data(user_id, data)
         except Exception as e:
             self.logger.error(f"Ошибка при сохранении кардио пользователя {user_id}: {e}")
             return False
@@ -197,12 +663,10 @@ class DataManager:
         try:
             if not exercises or len(exercises) > 1000:
                 return False
-            data = self.load_user_data(user_id)
-            data['strength'].append({
-                'date': datetime.now().strftime('%Y-%m-%d'),
+            return self._append_entry(user_id, 'strength', {
+                'date': self.user_local_date(user_id),
                 'exercises': exercises
             })
-            return self.save_user_data(user_id, data)
         except Exception as e:
             self.logger.error(f"Ошибка при сохранении силовой тренировки пользователя {user_id}: {e}")
             return False
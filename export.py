@@ -0,0 +1,93 @@
+import csv
+import io
+import logging
+import tempfile
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+from data_manager import data_manager
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # XLSX - необязательная возможность
+    Workbook = None
+
+logger = logging.getLogger(__name__)
+
+# До такого размера выгрузка держится в памяти, крупнее - во временном файле на диске
+SPOOL_MAX_SIZE = 1024 * 1024
+
+EXPORT_COLUMNS = ['user_id', 'name', 'date', 'activity', 'value', 'details']
+
+# Поле записи -> (название активности, значение, подробности)
+ACTIVITY_FIELDS = {
+    'meals': ('meal', lambda entry: 1, lambda entry: entry.get('photo_id', '')),
+    'cardio': ('cardio', lambda entry: entry.get('duration'), lambda entry: ''),
+    'strength': ('strength', lambda entry: 1, lambda entry: entry.get('exercises', '')),
+    'weight_history': ('weight', lambda entry: entry.get('weight'), lambda entry: '')
+}
+
+def xlsx_available() -> bool:
+    """Установлен ли openpyxl для выгрузки в XLSX"""
+    return Workbook is not None
+
+def iter_activity_rows(user_ids: Optional[Sequence[str]] = None, date_from: Optional[str] = None,
+                       date_to: Optional[str] = None) -> Iterator[List]:
+    """Строки активностей участников, по одному участнику за раз
+
+    Даты - в формате YYYY-MM-DD, границы включаются.
+    """
+    wanted = set(user_ids) if user_ids else None
+    for user in data_manager.get_all_users(include_unreachable=True):
+        user_id = user['user_id']
+        if wanted is not None and user_id not in wanted:
+            continue
+        user_data = data_manager.load_user_data(user_id)
+        for field, (activity, value, details) in ACTIVITY_FIELDS.items():
+            for entry in user_data.get(field, []):
+                date = entry['date'][:10]
+                if (date_from and date < date_from) or (date_to and date > date_to):
+                    continue
+                yield [user_id, user['name'], date, activity, value(entry), details(entry)]
+
+def write_csv(rows: Iterable[List], f) -> int:
+    """Пишет строки в двоичный файл как CSV (UTF-8 с BOM - чтобы Excel понял кириллицу)"""
+    text = io.TextIOWrapper(f, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow(EXPORT_COLUMNS)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    text.flush()
+    # Отцепляем обёртку, чтобы она не закрыла файл
+    text.detach()
+    return count
+
+def write_xlsx(rows: Iterable[List], f) -> int:
+    """Пишет строки в двоичный файл как XLSX (потоковый режим openpyxl)"""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Activities')
+    sheet.append(EXPORT_COLUMNS)
+    count = 0
+    for row in rows:
+        sheet.append(row)
+        count += 1
+    workbook.save(f)
+    return count
+
+def build_export(fmt: str = 'csv', user_ids: Optional[Sequence[str]] = None,
+                 date_from: Optional[str] = None, date_to: Optional[str] = None) -> Tuple[tempfile.SpooledTemporaryFile, int]:
+    """Собирает выгрузку во временный файл; возвращает файл (в начале) и число строк
+
+    Блокирующая функция: из обработчиков вызывать через asyncio.to_thread.
+    """
+    if fmt == 'xlsx' and not xlsx_available():
+        raise ValueError('Для выгрузки в XLSX установите openpyxl')
+    f = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        rows = iter_activity_rows(user_ids, date_from, date_to)
+        count = write_xlsx(rows, f) if fmt == 'xlsx' else write_csv(rows, f)
+        f.seek(0)
+        return f, count
+    except Exception:
+        f.close()
+        raise
@@ -0,0 +1,28 @@
+import os
+import argparse
+import logging
+from storage import migrate_json_to_sqlite
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+def main():
+    """Однократный перенос data/users/*.json в базу SQLite"""
+    parser = argparse.ArgumentParser(description='Перенос данных участников из JSON в SQLite')
+    parser.add_argument('--users-dir', default=os.path.join(DATA_DIR, 'users'),
+                        help='каталог с файлами <user_id>.json')
+    parser.add_argument('--db', default=os.getenv('DATA_SQLITE_PATH') or os.path.join(DATA_DIR, 'fit.db'),
+                        help='путь к базе SQLite')
+    args = parser.parse_args()
+    
+    migrated = migrate_json_to_sqlite(args.users_dir, args.db)
+    logger.info(f"Перенесено участников: {migrated} -> {args.db}")
+    logger.info("Чтобы бот работал с базой, укажите DATA_STORAGE=sqlite в .env")
+
+if __name__ == '__main__':
+    main()
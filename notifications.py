@@ -1,10 +1,30 @@
+import json
 import logging
-from datetime import datetime, timedelta
+import os
+import re
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from telegram.ext import ContextTypes
-from data_manager import data_manager
+from data_manager import data_manager, DEFAULT_TIMEZONE
+from compliance import compliance, is_weigh_in_day
 import random
-from telegram import Bot
-from telegram.error import Forbidden
+from outbox import outbox
+
+logger = logging.getLogger(__name__)
+
+# Время уведомлений по умолчанию (местное время пользователя)
+DEFAULT_NOTIFICATION_TIMES = {'morning': '09:00', 'evening': '20:00'}
+# Уведомления пользователей размазываются по стольким минутам после выбранного времени
+SCHEDULE_JITTER_MINUTES = int(os.getenv('SCHEDULE_JITTER_MINUTES', '10'))
+# Сколько пользователей в одной пачке рассылки
+SCHEDULE_BATCH_SIZE = 50
+# За сколько минут после перезапуска досылаются пропущенные уведомления
+SCHEDULE_CATCHUP_MINUTES = int(os.getenv('SCHEDULE_CATCHUP_MINUTES', '120'))
+# Как часто полностью перестраивать расписание (изменения из другого процесса), секунд
+SCHEDULE_REBUILD_INTERVAL = 600
+SCHEDULE_STATE_FILE = os.path.join(os.path.dirname(__file__), 'data', 'notification_state.json')
 
 # Мотивационные сообщения для утра
 MORNING_MESSAGES = [
@@ -15,27 +35,18 @@ MORNING_MESSAGES = [
     "✨ Ты на верном пути! Продолжай в том же духе!"
 ]
 
-async def send_message_safely(bot, chat_id: str, text: str) -> bool:
-    """Безопасная отправка сообщения с обработкой ошибок"""
-    try:
-        await bot.send_message(chat_id=chat_id, text=text)
-        return True
-    except Forbidden as e:
-        if "bot was blocked by the user" in str(e):
-            logging.warning(f"Пользователь {chat_id} заблокировал бота")
-        return False
-    except Exception as e:
-        logging.error(f"Ошибка отправки сообщения пользователю {chat_id}: {e}")
-        return False
+def _local_date(dates: Optional[Dict[str, str]], user_id: str) -> str:
+    """Местная дата пользователя из пачки планировщика, без неё - по его часовому поясу"""
+    return (dates or {}).get(user_id) or data_manager.user_local_date(user_id)
 
-async def send_morning_message(context: ContextTypes.DEFAULT_TYPE):
-    """Отправляет утреннее мотивационное сообщение"""
-    users = data_manager.get_all_users()
-    today = datetime.now()
-    
+def build_morning_messages(users, dates: Optional[Dict[str, str]] = None):
+    """Готовит утренние сообщения: пары (user_id, текст)
+
+    dates - местные даты пользователей (user_id -> YYYY-MM-DD), по ним считается день марафона.
+    """
     for user in users:
         user_id = user['user_id']
-        stats = data_manager.get_user_stats(user_id)
+        stats = data_manager.get_user_stats(user_id, _local_date(dates, user_id))
         
         message = (
             f"🌅 Доброе утро, {user['name']}!\n\n"
@@ -45,47 +56,65 @@ async def send_morning_message(context: ContextTypes.DEFAULT_TYPE):
             f"📝 Вноси данные для отслеживания прогресса!"
         )
         
-        await send_message_safely(context.bot, user_id, message)
+        yield user_id, message
 
-async def send_evening_reminders(context: ContextTypes.DEFAULT_TYPE):
-    """Отправляет вечерние напоминания о невыполненных задачах"""
-    users = data_manager.get_all_users()
-    today = datetime.now()
-    is_friday = today.weekday() == 4
+def _job_users(context: ContextTypes.DEFAULT_TYPE) -> List[Dict]:
+    """Пользователи пачки из планировщика, а без неё - все"""
+    job = getattr(context, 'job', None)
+    if job is not None and isinstance(job.data, dict) and 'users' in job.data:
+        return job.data['users']
+    return data_manager.get_all_users()
+
+def _job_dates(context: ContextTypes.DEFAULT_TYPE) -> Optional[Dict[str, str]]:
+    """Местные даты пользователей пачки из планировщика (user_id -> дата)"""
+    job = getattr(context, 'job', None)
+    if job is not None and isinstance(job.data, dict):
+        return job.data.get('dates')
+    return None
+
+async def send_morning_message(context: ContextTypes.DEFAULT_TYPE):
+    """Отправляет утреннее мотивационное сообщение"""
+    users = _job_users(context)
+    # Рассылка идёт в общей очереди с низким приоритетом: ответы тренера её обгоняют
+    return await outbox.broadcast('bot', build_morning_messages(users, _job_dates(context)), name='morning')
+
+def build_evening_reminders(users, dates: Optional[Dict[str, str]] = None):
+    """Готовит вечерние напоминания: пары (user_id, текст) для тех, кому есть что напомнить
+
+    dates - местные даты пользователей (user_id -> YYYY-MM-DD): план проверяется за их «сегодня».
+    """
+    # В пачке бывают разные местные даты - выполнение плана берём из отчёта за каждую
+    by_date: Dict[str, List[Dict]] = {}
+    for user in users:
+        by_date.setdefault(_local_date(dates, user['user_id']), []).append(user)
+    
+    for today, day_users in by_date.items():
+        yield from _evening_reminders_for_date(day_users, today)
+
+def _evening_reminders_for_date(users, today: str):
+    is_friday = is_weigh_in_day(today)
+    rows = compliance.rows([user['user_id'] for user in users], today)
     
     for user in users:
         user_id = user['user_id']
-        stats = data_manager.get_user_stats(user_id)
+        row = rows[user_id]
         reminders = []
-        
+
         # Проверяем приемы пищи (обязательно минимум 3)
-        if stats['today_meals'] < 3:
+        if not row['meals_ok']:
             reminders.append(
-                f"🍽 Не забудь внести приемы пищи (минимум 3, сейчас {stats['today_meals']})"
+                f"🍽 Не забудь внести приемы пищи (минимум 3, сейчас {row['meals']})"
             )
         
         # Проверяем тренировки (нужна хотя бы одна - кардио ИЛИ силовая)
-        if not stats['today_cardio'] and not stats['today_strength']:
+        if not row['workout']:
             reminders.append(
                 "💪 Не забудь выполнить тренировку (кардио или силовую)"
             )
         
-        # Проверяем вес только по пятницам
-        if is_friday:
-            # Проверяем, был ли внесен вес за последние 7 дней
-            user_data = data_manager.load_user_data(user_id)
-            weight_history = user_data.get('weight_history', [])
-            
-            # Получаем дату последнего взвешивания
-            last_weight_date = None
-            if weight_history:
-                last_weight = weight_history[-1]
-                last_weight_date = datetime.strptime(last_weight['date'], '%Y-%m-%d')
-            
-            # Проверяем, было ли взвешивание на этой неделе
-            start_of_week = today - timedelta(days=today.weekday())
-            if not last_weight_date or last_weight_date < start_of_week:
-                reminders.append("⚖️ Не забудь внести свой вес за эту неделю")
+        # Проверяем вес только по пятницам: было ли взвешивание на этой неделе
+        if is_friday and not row['weighed_week']:
+            reminders.append("⚖️ Не забудь внести свой вес за эту неделю")
         
         # Если есть напоминания, отправляем сообщение
         if reminders:
@@ -100,18 +129,232 @@ async def send_evening_reminders(context: ContextTypes.DEFAULT_TYPE):
                 f"💪 Ты сможешь! Действуй!"
             )
             
-            await send_message_safely(context.bot, user_id, message)
+            yield user_id, message
+
+async def send_evening_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Отправляет вечерние напоминания о невыполненных задачах"""
+    users = _job_users(context)
+    # Рассылка идёт в общей очереди с низким приоритетом: ответы тренера её обгоняют
+    return await outbox.broadcast('bot', build_evening_reminders(users, _job_dates(context)), name='evening')
+
+NOTIFICATION_SENDERS = {
+    'morning': send_morning_message,
+    'evening': send_evening_reminders
+}
+
+def parse_timezone(value: str) -> Optional[str]:
+    """Имя часового пояса из ввода пользователя: Europe/Moscow, UTC, UTC+3, -5; None - не распознан"""
+    value = value.strip()
+    match = re.fullmatch(r'(?:UTC|GMT)?\s*([+-])\s*(\d{1,2})', value, re.IGNORECASE)
+    if match:
+        hours = int(match.group(2))
+        if hours > 14:
+            return None
+        # В зонах Etc/GMT знак обратный: Etc/GMT-3 - это UTC+3
+        return 'UTC' if hours == 0 else f"Etc/GMT{'-' if match.group(1) == '+' else '+'}{hours}"
+    if value.upper() in ('UTC', 'GMT'):
+        return 'UTC'
+    try:
+        ZoneInfo(value)
+        return value
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+def parse_time(value: str) -> Optional[str]:
+    """Время ЧЧ:ММ из ввода пользователя; None - не распознано"""
+    try:
+        return datetime.strptime(value.strip(), '%H:%M').strftime('%H:%M')
+    except ValueError:
+        return None
+
+def user_notification_settings(user_data: Dict):
+    """Часовой пояс и время уведомлений пользователя с учётом значений по умолчанию"""
+    times = dict(DEFAULT_NOTIFICATION_TIMES)
+    times.update(user_data.get('notification_times') or {})
+    return user_data.get('timezone') or DEFAULT_TIMEZONE, times
+
+class NotificationScheduler:
+    """Рассылки по местному времени пользователей небольшими пачками
+
+    Раз в минуту находит пользователей, у которых наступило время уведомления,
+    и отправляет их пачками через job_queue в случайные моменты этой минуты.
+    Время каждого пользователя сдвинуто на постоянные 0..jitter минут
+    (по его ID), чтобы популярное 09:00 не превращалось в один всплеск.
+    Кому что отправлено, хранится на диске: после перезапуска пропущенные
+    за последние catchup минут уведомления досылаются, а отправленные не повторяются.
+    """
+
+    def __init__(self, state_file: str = SCHEDULE_STATE_FILE, jitter_minutes: int = SCHEDULE_JITTER_MINUTES,
+                 batch_size: int = SCHEDULE_BATCH_SIZE, catchup_minutes: int = SCHEDULE_CATCHUP_MINUTES):
+        self.state_file = state_file
+        self.jitter_minutes = jitter_minutes
+        self.batch_size = batch_size
+        self.catchup_minutes = catchup_minutes
+        # (часовой пояс, вид, минута суток) -> пользователи
+        self._slots: Dict[tuple, List[Dict]] = {}
+        # user_id -> его ключи в _slots (для точечного обновления)
+        self._user_slots: Dict[str, List[tuple]] = {}
+        self._stale = set()
+        self._built_at: Optional[datetime] = None
+        self._last_minute: Optional[datetime] = None
+        # вид -> user_id -> местная дата последней отправки (сохраняется на диск)
+        self._sent: Dict[str, Dict[str, str]] = {kind: {} for kind in NOTIFICATION_SENDERS}
+        # То же для пачек, которые запланированы, но ещё не отправлены (только в памяти)
+        self._pending: Dict[str, Dict[str, str]] = {kind: {} for kind in NOTIFICATION_SENDERS}
+        self._restored = False
+        self._load_state()
+        data_manager.add_listener(self._stale.add)
+
+    def _load_state(self):
+        try:
+            if os.path.exists(self.state_file):
+                with open(self.state_file, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                for kind, sent in state.get('sent', {}).items():
+                    self._sent.setdefault(kind, {}).update(sent)
+                if state.get('last_minute'):
+                    self._last_minute = datetime.fromisoformat(state['last_minute'])
+                    self._restored = True
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке состояния рассылок: {e}")
+
+    def _save_state(self):
+        """Атомарно сохраняет состояние; старые отметки об отправке отбрасываются"""
+        try:
+            oldest = (datetime.now(timezone.utc) - timedelta(days=2)).strftime('%Y-%m-%d')
+            for sent in self._sent.values():
+                for user_id in [user_id for user_id, date in sent.items() if date < oldest]:
+                    del sent[user_id]
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            tmp_path = self.state_file + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'last_minute': self._last_minute.isoformat() if self._last_minute else None,
+                    'sent': self._sent
+                }, f)
+            os.replace(tmp_path, self.state_file)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении состояния рассылок: {e}")
+
+    def _slot_minute(self, user_id: str, preferred: str) -> int:
+        """Минута суток уведомления с постоянным сдвигом пользователя"""
+        hours, minutes = map(int, preferred.split(':'))
+        shift = zlib.crc32(user_id.encode()) % self.jitter_minutes if self.jitter_minutes > 0 else 0
+        return (hours * 60 + minutes + shift) % (24 * 60)
+
+    def _remove_user(self, user_id: str):
+        for key in self._user_slots.pop(user_id, []):
+            self._slots[key] = [user for user in self._slots[key] if user['user_id'] != user_id]
+
+    def _add_user(self, user: Dict):
+        user_data = data_manager.load_user_data(user['user_id'])
+        tz_name, times = user_notification_settings(user_data)
+        keys = []
+        for kind, preferred in times.items():
+            if kind not in NOTIFICATION_SENDERS or not preferred:
+                continue
+            key = (tz_name, kind, self._slot_minute(user['user_id'], preferred))
+            self._slots.setdefault(key, []).append({'user_id': user['user_id'], 'name': user['name']})
+            keys.append(key)
+        self._user_slots[user['user_id']] = keys
+
+    def _refresh(self, now: datetime):
+        """Перестраивает расписание целиком или только для изменившихся пользователей"""
+        if self._built_at is None or (now - self._built_at).total_seconds() >= SCHEDULE_REBUILD_INTERVAL:
+            self._slots, self._user_slots = {}, {}
+            self._stale.clear()
+            for user in data_manager.get_all_users():
+                self._add_user(user)
+            self._built_at = now
+            return
+        stale, self._stale = self._stale, set()
+        for user_id in stale:
+            self._remove_user(user_id)
+            user_data = data_manager.load_user_data(user_id)
+            if user_data.get('name') and not user_data.get('delivery_status'):
+                self._add_user({'user_id': user_id, 'name': user_data['name']})
+
+    def due(self, minute: datetime) -> Dict[str, Dict[str, tuple]]:
+        """Кому пора отправить уведомления в эту минуту (UTC): вид -> {user_id: (пользователь, местная дата)}"""
+        due = {kind: {} for kind in NOTIFICATION_SENDERS}
+        for tz_name in {key[0] for key in self._slots}:
+            try:
+                local = minute.astimezone(ZoneInfo(tz_name))
+            except (ZoneInfoNotFoundError, ValueError):
+                continue
+            local_minute = local.hour * 60 + local.minute
+            local_date = local.strftime('%Y-%m-%d')
+            for kind in NOTIFICATION_SENDERS:
+                for user in self._slots.get((tz_name, kind, local_minute), []):
+                    if local_date not in (self._sent[kind].get(user['user_id']),
+                                          self._pending[kind].get(user['user_id'])):
+                        due[kind][user['user_id']] = (user, local_date)
+        return due
+
+    async def tick(self, context: ContextTypes.DEFAULT_TYPE):
+        """Задача раз в минуту: раздаёт пачки уведомлений наступивших минут"""
+        now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        self._refresh(now)
+        if self._last_minute is None:
+            start = now
+        elif self._restored:
+            # После перезапуска досылаем пропущенное, включая пачки последней минуты,
+            # которые могли не успеть уйти; отправленное отсекают отметки
+            start = max(self._last_minute - timedelta(minutes=1), now - timedelta(minutes=self.catchup_minutes))
+            self._restored = False
+        else:
+            start = self._last_minute + timedelta(minutes=1)
+        
+        minute = start
+        while minute <= now:
+            for kind, users in self.due(minute).items():
+                self._schedule_batches(context, kind, list(users.values()), catchup=minute < now)
+            minute += timedelta(minutes=1)
+        self._last_minute = now
+        self._save_state()
+
+    def _schedule_batches(self, context: ContextTypes.DEFAULT_TYPE, kind: str, due: List, catchup: bool):
+        for i in range(0, len(due), self.batch_size):
+            batch = due[i:i + self.batch_size]
+            # Пачки расходятся по минуте, чтобы не отправлять всё в её начале
+            context.job_queue.run_once(
+                self._run_batch,
+                when=random.uniform(0, 55),
+                data={
+                    'kind': kind,
+                    'users': [user for user, _ in batch],
+                    'dates': {user['user_id']: date for user, date in batch}
+                },
+                name=f'{kind}_batch'
+            )
+            # До отправки пачки не планируем её повторно
+            for user, date in batch:
+                self._pending[kind][user['user_id']] = date
+        if due:
+            logger.info(f"Рассылка {kind}: {len(due)} пользователей{' (досылка)' if catchup else ''}")
+
+    async def _run_batch(self, context: ContextTypes.DEFAULT_TYPE):
+        """Отправляет одну пачку уведомлений"""
+        kind = context.job.data['kind']
+        dates = context.job.data['dates']
+        try:
+            await NOTIFICATION_SENDERS[kind](context)
+            self._sent[kind].update(dates)
+            self._save_state()
+        except Exception as e:
+            # Не отмечаем отправленными: после перезапуска пачку подберёт досылка
+            logger.error(f"Ошибка при отправке пачки уведомлений {kind}: {e}")
+        finally:
+            for user_id in dates:
+                self._pending[kind].pop(user_id, None)
 
 def setup_notifications(application):
-    """Настраивает расписание уведомлений"""
-    # Утреннее сообщение в 9:00
-    application.job_queue.run_daily(
-        send_morning_message,
-        time=datetime.strptime("09:00", "%H:%M").time()
+    """Настраивает расписание уведомлений: проверка раз в минуту по местному времени пользователей"""
+    scheduler = NotificationScheduler()
+    now = datetime.now()
+    application.job_queue.run_repeating(
+        scheduler.tick,
+        interval=60,
+        first=60 - now.second - now.microsecond / 1_000_000
     )
-    
-    # Вечерние напоминания в 20:00
-    application.job_queue.run_daily(
-        send_evening_reminders,
-        time=datetime.strptime("20:00", "%H:%M").time()
-    ) 
\ No newline at end of file
+    return scheduler
@@ -0,0 +1,285 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterable, Optional, Tuple
+from dotenv import load_dotenv
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut, NetworkError
+from broadcast import TokenBucket, GLOBAL_RATE, PER_CHAT_INTERVAL, MAX_RETRIES
+from data_manager import data_manager
+from photo_relay import photo_relay
+from telegram_clients import get_bot
+
+# Загрузка переменных окружения (токены ботов)
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Очереди по приоритету: меньше - раньше
+INTERACTIVE = 0  # ответы тренера участникам
+ADMIN = 1  # уведомления тренеру
+BULK = 2  # рассылки
+
+# Боты, от имени которых уходят сообщения. В очереди на диске хранится имя, а не токен
+BOT_TOKENS = {
+    'bot': os.getenv('BOT_TOKEN'),
+    'admin': os.getenv('ADMIN_BOT_TOKEN')
+}
+
+OUTBOX_WORKERS = 8
+SAVE_INTERVAL = 5  # секунд между сохранениями очереди на диск
+BACKLOG_FILE = os.path.join(os.path.dirname(__file__), 'data', 'outbox_{name}.json')
+
+class Outbox:
+    """Общая очередь исходящих сообщений
+
+    Сообщения уходят по приоритету (ответы тренера, затем уведомления тренеру,
+    затем рассылки) с общим ограничением частоты на бота и паузой между
+    сообщениями в один чат. Ошибки сети повторяются с нарастающей задержкой,
+    RetryAfter приостанавливает все отправки бота. Неотправленные сообщения
+    сохраняются на диск и дошлются после перезапуска.
+    """
+
+    def __init__(self, workers: int = OUTBOX_WORKERS, rate: float = GLOBAL_RATE,
+                 per_chat_interval: float = PER_CHAT_INTERVAL, max_retries: int = MAX_RETRIES,
+                 save_interval: float = SAVE_INTERVAL):
+        self.workers = workers
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.save_interval = save_interval
+        self.backlog_file: Optional[str] = None
+        # Ждущие отправки сообщения: id -> сообщение (их и сохраняем на диск)
+        self._pending: Dict[int, Dict] = {}
+        self._futures: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._order = itertools.count()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._buckets: Dict[str, TokenBucket] = {}
+        # Ближайшее свободное время отправки в чат: (бот, chat_id) -> monotonic
+        self._next_slot: Dict[Tuple[str, str], float] = {}
+        self._tasks = []
+        self._dirty = False
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def _load_backlog(self):
+        """Возвращает в очередь сообщения, не отправленные до остановки"""
+        try:
+            if os.path.exists(self.backlog_file):
+                with open(self.backlog_file, 'r', encoding='utf-8') as f:
+                    items = json.load(f)
+                for item in items:
+                    item['id'] = next(self._ids)
+                    self._enqueue(item)
+                if items:
+                    logger.info(f"Из очереди на диске восстановлено {len(items)} сообщений")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке очереди сообщений: {e}")
+
+    def _save_backlog(self):
+        """Атомарно сохраняет неотправленные сообщения"""
+        try:
+            os.makedirs(os.path.dirname(self.backlog_file), exist_ok=True)
+            tmp_path = self.backlog_file + '.tmp'
+            items = sorted(self._pending.values(), key=lambda item: (item['priority'], item['id']))
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump([{k: v for k, v in item.items() if k != 'id'} for item in items],
+                          f, ensure_ascii=False)
+            os.replace(tmp_path, self.backlog_file)
+            self._dirty = False
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении очереди сообщений: {e}")
+
+    async def _saver(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            if self._dirty:
+                self._save_backlog()
+            await photo_relay.save()
+
+    async def start(self, name: str = 'bot'):
+        """Запускает воркеры; name - имя файла очереди на диске (свой у каждого процесса)"""
+        if self.running:
+            return
+        self.backlog_file = BACKLOG_FILE.format(name=name)
+        self._queue = asyncio.PriorityQueue()
+        self._load_backlog()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._saver()))
+
+    async def stop(self):
+        """Останавливает воркеры и сохраняет неотправленные сообщения"""
+        if not self.running:
+            return
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._save_backlog()
+        await photo_relay.close()
+        for future in self._futures.values():
+            if not future.done():
+                future.cancel()
+        self._futures.clear()
+        self._pending.clear()
+
+    def _enqueue(self, item: Dict, delay: float = 0):
+        self._pending[item['id']] = item
+        self._dirty = True
+        entry = (item['priority'], next(self._order), item['id'])
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, entry)
+        else:
+            self._queue.put_nowait(entry)
+
+    def submit(self, bot: str, chat_id, text: str, priority: int = ADMIN,
+               reply_markup: Optional[InlineKeyboardMarkup] = None,
+               photo: Optional[Dict] = None, track_delivery: bool = False) -> asyncio.Future:
+        """Ставит сообщение в очередь и возвращает future с результатом 'sent', 'blocked' или 'failed'
+
+        bot - 'bot' (бот участников) или 'admin'. photo - {'bot', 'file_id', 'unique_id'}:
+        фото из указанного бота, text тогда становится подписью. track_delivery -
+        помечать получателя недоступным, если он заблокировал бота.
+        """
+        if not self.running:
+            raise RuntimeError('Очередь сообщений не запущена')
+        item = {
+            'id': next(self._ids),
+            'bot': bot,
+            'chat_id': str(chat_id),
+            'text': text,
+            'priority': priority,
+            'reply_markup': reply_markup.to_dict() if reply_markup else None,
+            'photo': photo,
+            'track_delivery': track_delivery,
+            'attempts': 0
+        }
+        future = asyncio.get_running_loop().create_future()
+        self._futures[item['id']] = future
+        self._enqueue(item)
+        return future
+
+    async def send(self, *args, **kwargs) -> str:
+        """Ставит сообщение в очередь и ждёт результата отправки"""
+        return await self.submit(*args, **kwargs)
+
+    async def broadcast(self, bot: str, messages: Iterable[Tuple[str, str]], name: str = 'broadcast') -> Dict:
+        """Рассылает пары (chat_id, текст) с низким приоритетом и возвращает метрики"""
+        started = time.monotonic()
+        futures = [
+            self.submit(bot, chat_id, text, priority=BULK, track_delivery=True)
+            for chat_id, text in messages
+        ]
+        metrics = {'sent': 0, 'blocked': 0, 'failed': 0, 'elapsed': 0.0}
+        for result in await asyncio.gather(*futures, return_exceptions=True):
+            metrics[result if isinstance(result, str) else 'failed'] += 1
+        metrics['elapsed'] = round(time.monotonic() - started, 2)
+        logger.info(
+            f"Рассылка {name}: отправлено {metrics['sent']}, заблокировали {metrics['blocked']}, "
+            f"ошибок {metrics['failed']}, за {metrics['elapsed']} с"
+        )
+        return metrics
+
+    def _bucket(self, bot: str) -> TokenBucket:
+        # Лимит частоты у Telegram свой у каждого бота
+        if bot not in self._buckets:
+            self._buckets[bot] = TokenBucket(self.rate)
+        return self._buckets[bot]
+
+    def _finish(self, item: Dict, result: str):
+        self._pending.pop(item['id'], None)
+        self._dirty = True
+        future = self._futures.pop(item['id'], None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def _retry(self, item: Dict, delay: float, error) -> bool:
+        """Откладывает повтор; False - попытки кончились"""
+        item['attempts'] += 1
+        if item['attempts'] > self.max_retries:
+            logger.error(f"Не удалось отправить сообщение в чат {item['chat_id']}: {error}")
+            self._finish(item, 'failed')
+            return False
+        self._enqueue(item, delay)
+        return True
+
+    def _mark_unreachable(self, item: Dict, status: str):
+        if not item['track_delivery']:
+            return
+        try:
+            data_manager.set_delivery_status(item['chat_id'], status)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении статуса доставки {item['chat_id']}: {e}")
+
+    async def _deliver(self, item: Dict):
+        """Одна попытка отправки сообщения"""
+        target_bot = await get_bot(BOT_TOKENS[item['bot']])
+        reply_markup = InlineKeyboardMarkup.de_json(item['reply_markup'], target_bot) if item['reply_markup'] else None
+        photo = item['photo']
+        if photo:
+            await photo_relay.relay(
+                source_bot=await get_bot(BOT_TOKENS[photo['bot']]),
+                target_bot=target_bot,
+                chat_id=item['chat_id'],
+                file_id=photo['file_id'],
+                unique_id=photo.get('unique_id'),
+                caption=item['text'],
+                reply_markup=reply_markup
+            )
+        else:
+            await target_bot.send_message(chat_id=item['chat_id'], text=item['text'], reply_markup=reply_markup)
+
+    async def _process(self, item: Dict):
+        # Место в очереди чата занимаем до ожидания: иначе несколько воркеров
+        # одновременно не видят недавних отправок и уходят в чат разом
+        chat_key = (item['bot'], item['chat_id'])
+        now = time.monotonic()
+        slot = max(now, self._next_slot.get(chat_key, now))
+        self._next_slot[chat_key] = slot + self.per_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        bucket = self._bucket(item['bot'])
+        await bucket.acquire()
+        try:
+            await self._deliver(item)
+            # Отсчёт паузы - и от фактической отправки (её могли задержать лимит бота или сеть)
+            self._next_slot[chat_key] = max(self._next_slot[chat_key], time.monotonic() + self.per_chat_interval)
+            self._finish(item, 'sent')
+        except RetryAfter as e:
+            # Флуд-контроль действует на весь бот - приостанавливаем все его отправки
+            logger.warning(f"RetryAfter {e.retry_after} с при отправке в чат {item['chat_id']}")
+            bucket.pause(e.retry_after)
+            self._enqueue(item, e.retry_after)
+        except Forbidden as e:
+            logger.warning(f"Пользователь {item['chat_id']} заблокировал бота: {e}")
+            self._mark_unreachable(item, 'blocked')
+            self._finish(item, 'blocked')
+        except BadRequest as e:
+            if 'chat not found' not in str(e).lower():
+                logger.error(f"Ошибка отправки сообщения в чат {item['chat_id']}: {e}")
+                self._finish(item, 'failed')
+                return
+            logger.warning(f"Чат {item['chat_id']} недоступен: {e}")
+            self._mark_unreachable(item, 'unreachable')
+            self._finish(item, 'blocked')
+        except (TimedOut, NetworkError) as e:
+            self._retry(item, 2 ** item['attempts'], e)
+        except Exception as e:
+            logger.error(f"Ошибка отправки сообщения в чат {item['chat_id']}: {e}")
+            self._finish(item, 'failed')
+
+    async def _worker(self):
+        while True:
+            _, _, item_id = await self._queue.get()
+            item = self._pending.get(item_id)
+            if item is not None:
+                await self._process(item)
+
+# Общая очередь процесса
+outbox = Outbox()
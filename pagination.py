@@ -0,0 +1,81 @@
+import time
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Sequence, Tuple
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message
+
+# Ограничение Telegram на длину одного сообщения
+MESSAGE_LIMIT = 4096
+# Сколько готовых страниц держим и сколько секунд им доверяем: изменения
+# из другого процесса счётчик версий данных этого процесса не видит
+PAGE_CACHE_SIZE = 256
+PAGE_CACHE_TTL = 60
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Делит текст на части не длиннее limit по границам строк"""
+    chunks = []
+    current = ''
+    for line in text.splitlines(keepends=True):
+        if len(current) + len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ''
+            # Строка длиннее лимита - режем её саму
+            while len(line) > limit:
+                chunks.append(line[:limit])
+                line = line[limit:]
+        current += line
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+async def send_chunked(message: Message, text: str, reply_markup=None):
+    """Отправляет длинный текст несколькими сообщениями; клавиатура - у последнего"""
+    chunks = split_message(text)
+    for i, chunk in enumerate(chunks):
+        await message.reply_text(chunk, reply_markup=reply_markup if i == len(chunks) - 1 else None)
+
+def page_count(total: int, per_page: int) -> int:
+    return max(1, (total + per_page - 1) // per_page)
+
+def page_slice(items: Sequence, page: int, per_page: int) -> Tuple[Sequence, int, int]:
+    """Элементы страницы, номер страницы (приведённый к допустимому) и число страниц"""
+    pages = page_count(len(items), per_page)
+    page = max(0, min(page, pages - 1))
+    return items[page * per_page:(page + 1) * per_page], page, pages
+
+def page_keyboard(view: str, page: int, pages: int) -> Optional[InlineKeyboardMarkup]:
+    """Кнопки ⬅️/➡️ для страниц; средняя кнопка обновляет текущую страницу"""
+    if pages <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️", callback_data=f"page_{view}_{page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"page_{view}_{page}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("➡️", callback_data=f"page_{view}_{page + 1}"))
+    return InlineKeyboardMarkup([buttons])
+
+class PageCache:
+    """Готовые страницы по ключу (вид, дата, версия данных, ...) с ограниченным сроком жизни"""
+
+    def __init__(self, max_entries: int = PAGE_CACHE_SIZE, ttl: float = PAGE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        created, value = entry
+        if time.monotonic() - created > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,141 @@
+import os
+import json
+import asyncio
+import logging
+import tempfile
+from collections import OrderedDict
+from typing import Dict, Optional
+import aiohttp
+from telegram import Bot, InlineKeyboardMarkup, Message
+from telegram.error import BadRequest, NetworkError
+
+logger = logging.getLogger(__name__)
+
+# До такого размера фото держим в памяти, крупнее - во временном файле на диске
+SPOOL_MAX_SIZE = 256 * 1024
+# Фото скачивается кусками такого размера
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 60  # секунд на скачивание одного фото
+# Сколько уже пересланных фото помним
+CACHE_MAX_ENTRIES = 5000
+CACHE_FILE = os.path.join(os.path.dirname(__file__), 'data', 'photo_relay_cache.json')
+
+class PhotoRelay:
+    """Пересылка фото из одного бота в другой
+    
+    file_id у каждого бота свой, поэтому фото приходится скачивать основным
+    ботом и загружать админ-ботом. Фото скачивается кусками во временный файл
+    с ограниченным буфером в памяти, а file_id, выданный админ-боту, запоминается
+    по file_unique_id (он одинаков для одного содержимого у всех ботов):
+    повторная пересылка того же фото обходится без скачивания и загрузки.
+    Кэш сохраняется на диск пачкой (save() из очереди сообщений), а не после
+    каждой пересылки.
+    """
+    
+    def __init__(self, cache_file: str = CACHE_FILE, max_entries: int = CACHE_MAX_ENTRIES):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self._cache: OrderedDict = OrderedDict()
+        self._dirty = False
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._load_cache()
+    
+    def _load_cache(self):
+        """Загружает кэш пересланных фото с диска"""
+        try:
+            if os.path.exists(self.cache_file):
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    self._cache.update(json.load(f))
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке кэша фото: {e}")
+    
+    def _save_cache(self, entries: Dict[str, str]) -> bool:
+        """Атомарно сохраняет кэш пересланных фото"""
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            tmp_path = self.cache_file + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.cache_file)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении кэша фото: {e}")
+            return False
+    
+    async def save(self):
+        """Сохраняет кэш, если он менялся; файл пишется в отдельном потоке"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        if not await asyncio.to_thread(self._save_cache, dict(self._cache)):
+            self._dirty = True
+    
+    async def close(self):
+        """Сохраняет кэш и закрывает HTTP-сессию скачивания"""
+        await self.save()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+    
+    def _remember(self, unique_id: str, target_file_id: str):
+        self._cache[unique_id] = target_file_id
+        self._cache.move_to_end(unique_id)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        self._dirty = True
+    
+    async def _download(self, file, buffer):
+        """Скачивает файл Bot API в buffer кусками, не держа его в памяти целиком"""
+        if not file.file_path.startswith(('http://', 'https://')):
+            # Локальный сервер Bot API: файл уже лежит на диске
+            await file.download_to_memory(out=buffer)
+            return
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT))
+        try:
+            async with self._session.get(file.file_path) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    buffer.write(chunk)
+        except aiohttp.ClientResponseError as e:
+            if e.status < 500:
+                raise BadRequest(f"Не удалось скачать фото: {e}") from e
+            raise NetworkError(f"Не удалось скачать фото: {e}") from e
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Очередь сообщений повторяет отправку при сетевых ошибках
+            raise NetworkError(f"Не удалось скачать фото: {e}") from e
+    
+    async def relay(self, source_bot: Bot, target_bot: Bot, chat_id: int, file_id: str,
+                    unique_id: Optional[str] = None, caption: Optional[str] = None,
+                    reply_markup: Optional[InlineKeyboardMarkup] = None) -> Message:
+        """Отправляет фото источника (file_id source_bot) в чат через target_bot"""
+        cached_id = self._cache.get(unique_id) if unique_id else None
+        if cached_id:
+            try:
+                return await target_bot.send_photo(
+                    chat_id=chat_id,
+                    photo=cached_id,
+                    caption=caption,
+                    reply_markup=reply_markup
+                )
+            except BadRequest as e:
+                logger.warning(f"Закэшированный file_id больше не действителен: {e}")
+                self._cache.pop(unique_id, None)
+        
+        file = await source_bot.get_file(file_id)
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as buffer:
+            await self._download(file, buffer)
+            buffer.seek(0)
+            sent = await target_bot.send_photo(
+                chat_id=chat_id,
+                photo=buffer,
+                caption=caption,
+                reply_markup=reply_markup
+            )
+        
+        if sent.photo:
+            self._remember(unique_id or file.file_unique_id, sent.photo[-1].file_id)
+        return sent
+
+# Глобальный экземпляр пересылки фото
+photo_relay = PhotoRelay()
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import signal
+from typing import List
+from telegram.ext import Application
+from data_manager import data_manager
+from outbox import outbox
+from telegram_clients import register_bot, unregister_bot
+import bot
+import admin_bot
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+async def start_applications(applications: List[Application]):
+    """Инициализирует и запускает приложения ботов в текущем цикле событий
+
+    Клиенты всех приложений регистрируются до post_init, поэтому уведомления
+    админу и ответы тренера идут через клиент уже запущенного соседнего бота.
+    """
+    for application in applications:
+        await application.initialize()
+        register_bot(application.bot)
+    for application in applications:
+        # run_polling/run_webhook не используются, поэтому post_init вызываем сами
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+
+async def stop_applications(applications: List[Application]):
+    """Останавливает приложения ботов
+
+    Сначала все приложения перестают принимать и обрабатывать обновления, затем
+    один раз останавливается общая очередь сообщений и только потом закрываются
+    приложения: иначе post_shutdown первого бота остановил бы очередь, пока
+    второй ещё отвечает участникам.
+    """
+    for application in applications:
+        try:
+            if application.updater and application.updater.running:
+                await application.updater.stop()
+        except Exception as e:
+            logger.error(f"Ошибка при остановке получения обновлений: {e}")
+    for application in applications:
+        try:
+            if application.running:
+                await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        except Exception as e:
+            logger.error(f"Ошибка при остановке бота: {e}")
+    await outbox.stop()
+    for application in applications:
+        try:
+            unregister_bot(application.bot)
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+        except Exception as e:
+            logger.error(f"Ошибка при закрытии бота: {e}")
+    # Оба бота работали с одним кэшем данных - сбрасываем его
+    data_manager.flush()
+
+async def run():
+    """Запускает бота участников и админ-бота в одном процессе до сигнала остановки"""
+    applications = [bot.build_application(), admin_bot.build_application()]
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    try:
+        await start_applications(applications)
+        for application in applications:
+            await application.updater.start_polling()
+        logger.info("Бот участников и админ-бот запущены в одном процессе")
+        await stop_event.wait()
+    finally:
+        await stop_applications(applications)
+
+def main():
+    """Запуск обоих ботов в одном процессе (long polling)"""
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    main()
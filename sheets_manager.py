@@ -1,6 +1,12 @@
 import os
+import re
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import httplib2
 import pandas as pd
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
@@ -12,14 +18,348 @@ load_dotenv()
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SPREADSHEET_ID = os.getenv('GOOGLE_SHEETS_ID')  # ID таблицы из .env
+SHEETS_WORKERS = 4  # Потоков для запросов к Sheets API
+FLUSH_INTERVAL = 30  # Секунд между записями буфера
+FLUSH_SIZE = 100  # Строк в буфере, после которых пишем не дожидаясь таймера
+MAX_BACKOFF = 300  # Максимальная пауза после ошибки квоты, секунд
 
 class SheetsManager:
-    def __init__(self):
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL, flush_size: int = FLUSH_SIZE):
         self.creds = service_account.Credentials.from_service_account_file(
             'credentials.json', scopes=SCOPES)
         self.service = build('sheets', 'v4', credentials=self.creds)
         self.sheet = self.service.spreadsheets()
+        # Запросы googleapiclient синхронные - выполняем их в отдельных потоках,
+        # чтобы не блокировать цикл событий бота
+        self._executor = ThreadPoolExecutor(max_workers=SHEETS_WORKERS, thread_name_prefix='sheets')
+        self._local = threading.local()
+        # Буфер записи: обновления строк пользователей и новые строки отчётов
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending_users = {}
+        self._pending_reports = []
+        self._backoff = 0
+        self._retry_at = 0.0
+        self._flush_event = None
+        self._writer = None
+        # Индекс user_id -> номер строки в Sheet1, строится один раз при старте
+        self._row_index = None
+        # Локальная копия листа отчётов: user_id -> отчёты, и сколько строк уже прочитано
+        self._reports_by_user = {}
+        self._reports_rows = 0
+        self._reports_lock = None
         self.setup_sheets()
+        self._load_row_index()
+
+    def _http(self):
+        """HTTP-клиент текущего потока (httplib2 не потокобезопасен)"""
+        if not hasattr(self._local, 'http'):
+            self._local.http = AuthorizedHttp(self.creds, http=httplib2.Http())
+        return self._local.http
+
+    async def _execute(self, request):
+        """Выполняет запрос к Sheets API в пуле потоков"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: request.execute(http=self._http()))
+
+    def start(self):
+        """Запускает фоновую запись накопленных обновлений таблицы"""
+        if self._writer is None:
+            self._flush_event = asyncio.Event()
+            self._writer = asyncio.create_task(self._writer_loop())
+
+    async def stop(self):
+        """Записывает оставшиеся обновления и останавливает запись"""
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        await self.flush()
+        self._executor.shutdown(wait=False)
+
+    async def _writer_loop(self):
+        """Сбрасывает буфер по таймеру или при достижении размера пачки"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=max(self.flush_interval, self._backoff))
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            if self._backoff and not self._flush_due_to_backoff():
+                continue
+            await self.flush()
+
+    def _flush_due_to_backoff(self) -> bool:
+        """После ошибки квоты не пишем раньше, чем истечёт пауза"""
+        return asyncio.get_running_loop().time() >= self._retry_at
+
+    def _pending_count(self) -> int:
+        return len(self._pending_users) + len(self._pending_reports)
+
+    def _schedule(self):
+        self.start()
+        if self._pending_count() >= self.flush_size:
+            self._flush_event.set()
+
+    def enqueue_user_update(self, user_data):
+        """Ставит обновление данных пользователя в буфер и сразу возвращается"""
+        # Для пользователя достаточно последней версии строки
+        self._pending_users[str(user_data['user_id'])] = self._user_row(user_data)
+        self._schedule()
+
+    def enqueue_daily_report(self, user_data, activities):
+        """Ставит ежедневный отчёт в буфер и сразу возвращается"""
+        self._pending_reports.append(self._report_row(user_data, activities))
+        self._schedule()
+
+    async def flush(self):
+        """Записывает буфер: один batchUpdate для известных строк и по одному append на лист"""
+        users, self._pending_users = self._pending_users, {}
+        reports, self._pending_reports = self._pending_reports, []
+        
+        if users:
+            try:
+                await self._write_users(users)
+            except HttpError as error:
+                if not self._is_quota_error(error):
+                    print(f"An error occurred: {error}")
+                else:
+                    # Более свежие версии строк из буфера важнее повторяемых
+                    for user_id, row in users.items():
+                        self._pending_users.setdefault(user_id, row)
+                    self._register_quota_error(error)
+                    reports, self._pending_reports = [], reports + self._pending_reports
+        
+        if reports:
+            try:
+                await self._write_reports(reports)
+            except HttpError as error:
+                if not self._is_quota_error(error):
+                    print(f"An error occurred: {error}")
+                else:
+                    self._pending_reports = reports + self._pending_reports
+                    self._register_quota_error(error)
+                    return
+        
+        if self._pending_count() == 0:
+            self._backoff = 0
+
+    @staticmethod
+    def _is_quota_error(error: HttpError) -> bool:
+        """Ошибка квоты Sheets API: 429 или 403 с превышением лимита"""
+        status = getattr(error.resp, 'status', None)
+        return status == 429 or (status == 403 and 'rate' in str(error).lower())
+
+    def _register_quota_error(self, error: HttpError):
+        """Откладывает следующую запись с экспоненциальной паузой"""
+        self._backoff = min(max(self._backoff * 2, self.flush_interval), MAX_BACKOFF)
+        self._retry_at = asyncio.get_running_loop().time() + self._backoff
+        print(f"Sheets quota exceeded, retry in {self._backoff} s: {error}")
+
+    def _user_row(self, user_data):
+        """Строка основной таблицы для пользователя"""
+        return [
+            user_data['user_id'],
+            user_data['name'],
+            user_data.get('start_date', ''),
+            user_data.get('initial_weight', ''),
+            user_data.get('current_weight', ''),
+            user_data.get('weight_progress', ''),
+            user_data.get('marathon_day', ''),
+            'активен'
+        ]
+
+    def _report_row(self, user_data, activities):
+        """Строка листа ежедневных отчётов"""
+        return [
+            datetime.now().strftime("%d.%m.%Y"),
+            user_data['user_id'],
+            user_data['name'],
+            activities.get('meal_1', '❌'),
+            activities.get('meal_2', '❌'),
+            activities.get('meal_3', '❌'),
+            activities.get('meal_4', '❌'),
+            activities.get('meal_5', '❌'),
+            activities.get('meal_6', '❌'),
+            activities.get('cardio', '❌'),
+            activities.get('strength', '❌'),
+            activities.get('weight', ''),
+            activities.get('progress', ''),
+            activities.get('comments', '')
+        ]
+
+    async def _rebuild_row_index(self):
+        """Перечитывает колонку A и заново строит индекс user_id -> номер строки"""
+        result = await self._execute(self.sheet.values().get(
+            spreadsheetId=SPREADSHEET_ID,
+            range='Sheet1!A:A'
+        ))
+        self._row_index = self._index_rows(result.get('values', []))
+
+    @staticmethod
+    def _index_rows(values):
+        row_index = {}
+        for i, value in enumerate(values):
+            if i > 0 and value:  # Пропускаем заголовок
+                row_index.setdefault(value[0], i + 1)
+        return row_index
+
+    @staticmethod
+    def _first_row(a1_range: str) -> int:
+        """Номер первой строки из диапазона вида 'Sheet1'!A5:H7"""
+        return int(re.search(r'!\$?[A-Z]+\$?(\d+)', a1_range).group(1))
+
+    @staticmethod
+    def _is_range_error(error: HttpError) -> bool:
+        """Ошибка диапазона: строки из индекса в листе уже нет"""
+        message = str(error).lower()
+        return getattr(error.resp, 'status', None) == 400 and ('range' in message or 'grid limits' in message)
+
+    async def _index_matches(self, user_ids) -> bool:
+        """Проверяет, что в колонке A строк из индекса по-прежнему эти пользователи"""
+        try:
+            result = await self._execute(self.sheet.values().batchGet(
+                spreadsheetId=SPREADSHEET_ID,
+                ranges=[f'Sheet1!A{self._row_index[user_id]}' for user_id in user_ids]
+            ))
+        except HttpError as error:
+            if self._is_range_error(error):
+                return False
+            raise
+        for user_id, value_range in zip(user_ids, result.get('valueRanges', [])):
+            values = value_range.get('values') or [['']]
+            if str(values[0][0]) != str(user_id):
+                return False
+        return len(result.get('valueRanges', [])) == len(user_ids)
+
+    async def _write_users(self, rows, retried=False):
+        """Записывает строки пользователей: user_id -> строка
+
+        Перед записью колонка A целевых строк сверяется с индексом; если индекс
+        устарел, он перестраивается и запись повторяется один раз.
+        """
+        if self._row_index is None:
+            await self._rebuild_row_index()
+        
+        new_rows = {user_id: row for user_id, row in rows.items() if user_id not in self._row_index}
+        updates = [
+            {'range': f'Sheet1!A{self._row_index[user_id]}:H{self._row_index[user_id]}', 'values': [row]}
+            for user_id, row in rows.items() if user_id in self._row_index
+        ]
+        
+        if updates and not retried and not await self._index_matches([r for r in rows if r in self._row_index]):
+            # Строки вставляли, удаляли или сортировали - по старому индексу
+            # перезаписали бы чужие строки. Перестраиваем и пишем заново
+            print("Sheet1 row index mismatch, rebuilding")
+            self._row_index = None
+            await self._write_users(rows, retried=True)
+            return
+        
+        if updates:
+            try:
+                result = await self._execute(self.sheet.values().batchUpdate(
+                    spreadsheetId=SPREADSHEET_ID,
+                    body={'valueInputOption': 'RAW', 'data': updates}
+                ))
+                mismatch = result.get('totalUpdatedRows', len(updates)) != len(updates)
+            except HttpError as error:
+                # Остальные ошибки (квота, права, сбой сервера) разбирает flush()
+                if retried or not self._is_range_error(error):
+                    raise
+                mismatch = True
+            if mismatch and not retried:
+                # Таблицу меняли вручную - индекс устарел, перестраиваем и пишем заново
+                print("Sheet1 row index mismatch, rebuilding")
+                self._row_index = None
+                await self._write_users(rows, retried=True)
+                return
+            if mismatch:
+                print("Sheet1 row index still mismatched after rebuild")
+        
+        if new_rows:
+            result = await self._execute(self.sheet.values().append(
+                spreadsheetId=SPREADSHEET_ID,
+                range='Sheet1!A:H',
+                valueInputOption='RAW',
+                body={'values': list(new_rows.values())}
+            ))
+            first_row = self._first_row(result['updates']['updatedRange'])
+            for offset, user_id in enumerate(new_rows):
+                self._row_index[user_id] = first_row + offset
+
+    async def _write_reports(self, rows):
+        """Дописывает строки отчётов одним запросом"""
+        result = await self._execute(self.sheet.values().append(
+            spreadsheetId=SPREADSHEET_ID,
+            range='Daily Reports!A:N',
+            valueInputOption='RAW',
+            body={'values': rows}
+        ))
+        # Свои строки сразу кладём в локальную копию, если они легли сразу за известными.
+        # Под замком: если синхронизация уже дочитала эти строки, номер не совпадёт
+        async with self._get_reports_lock():
+            if self._reports_rows and self._first_row(result['updates']['updatedRange']) == self._reports_rows + 1:
+                self._add_reports(rows)
+
+    @staticmethod
+    def _report_from_row(row):
+        """Запись отчёта из строки листа (пустые ячейки в конце API не возвращает)"""
+        row = row + [''] * (14 - len(row))
+        return {
+            'date': row[0],
+            'meals': row[3:9],
+            'cardio': row[9],
+            'strength': row[10],
+            'weight': row[11],
+            'progress': row[12],
+            'comments': row[13]
+        }
+
+    def _add_reports(self, rows):
+        """Добавляет строки листа отчётов в локальную копию"""
+        for row in rows:
+            if len(row) > 1:
+                self._reports_by_user.setdefault(str(row[1]), []).append(self._report_from_row(row))
+        self._reports_rows += len(rows)
+
+    def _get_reports_lock(self) -> asyncio.Lock:
+        # Замок создаётся в цикле событий, а не в __init__
+        if self._reports_lock is None:
+            self._reports_lock = asyncio.Lock()
+        return self._reports_lock
+
+    async def _sync_reports(self):
+        """Дочитывает из листа отчётов только строки, появившиеся с прошлой синхронизации"""
+        async with self._get_reports_lock():
+            first_row = self._reports_rows + 1
+            try:
+                result = await self._execute(self.sheet.values().get(
+                    spreadsheetId=SPREADSHEET_ID,
+                    range=f'Daily Reports!A{first_row}:N'
+                ))
+            except HttpError as error:
+                # Лист заполнен ровно до конца сетки: диапазон за последней строкой
+                # API отвергает - значит, новых строк нет
+                if not self._is_range_error(error):
+                    raise
+                return
+            values = result.get('values', [])
+            if first_row == 1 and values:
+                # Заголовок
+                values = values[1:]
+                self._reports_rows = 1
+            self._add_reports(values)
+
+    def _load_row_index(self):
+        """Строит индекс строк пользователей при запуске"""
+        try:
+            result = self.sheet.values().get(
+                spreadsheetId=SPREADSHEET_ID,
+                range='Sheet1!A:A'
+            ).execute()
+            self._row_index = self._index_rows(result.get('values', []))
+        except HttpError as error:
+            # Построим при первой записи
+            print(f"An error occurred: {error}")
 
     def setup_sheets(self):
         """Создает структуру таблиц если она еще не создана"""
@@ -101,88 +441,24 @@ class SheetsManager:
     async def update_user_data(self, user_data):
         """Обновляет данные пользователя в основной таблице"""
         try:
-            # Подготовка данных
-            row = [
-                user_data['user_id'],
-                user_data['name'],
-                user_data.get('start_date', ''),
-                user_data.get('initial_weight', ''),
-                user_data.get('current_weight', ''),
-                user_data.get('weight_progress', ''),
-                user_data.get('marathon_day', ''),
-                'активен'
-            ]
-
-            # Поиск существующей строки или добавление новой
-            result = self.sheet.values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range='Sheet1!A:A'
-            ).execute()
-            
-            values = result.get('values', [])
-            user_row = None
-            for i, value in enumerate(values):
-                if value and value[0] == str(user_data['user_id']):
-                    user_row = i + 1
-                    break
-
-            if user_row:
-                range_name = f'Sheet1!A{user_row}:H{user_row}'
-                self.sheet.values().update(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=range_name,
-                    valueInputOption='RAW',
-                    body={'values': [row]}
-                ).execute()
-            else:
-                self.sheet.values().append(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range='Sheet1!A:H',
-                    valueInputOption='RAW',
-                    body={'values': [row]}
-                ).execute()
-
+            await self._write_users({str(user_data['user_id']): self._user_row(user_data)})
         except HttpError as error:
             print(f"An error occurred: {error}")
 
     async def add_daily_report(self, user_data, activities):
         """Добавляет ежедневный отчет"""
         try:
-            today = datetime.now().strftime("%d.%m.%Y")
-            row = [
-                today,
-                user_data['user_id'],
-                user_data['name'],
-                activities.get('meal_1', '❌'),
-                activities.get('meal_2', '❌'),
-                activities.get('meal_3', '❌'),
-                activities.get('meal_4', '❌'),
-                activities.get('meal_5', '❌'),
-                activities.get('meal_6', '❌'),
-                activities.get('cardio', '❌'),
-                activities.get('strength', '❌'),
-                activities.get('weight', ''),
-                activities.get('progress', ''),
-                activities.get('comments', '')
-            ]
-
-            self.sheet.values().append(
-                spreadsheetId=SPREADSHEET_ID,
-                range='Daily Reports!A:N',
-                valueInputOption='RAW',
-                body={'values': [row]}
-            ).execute()
-
+            await self._write_reports([self._report_row(user_data, activities)])
         except HttpError as error:
             print(f"An error occurred: {error}")
 
     async def get_all_users(self):
         """Получает список всех пользователей"""
         try:
-            result = self.sheet.values().get(
+            result = await self._execute(self.sheet.values().get(
                 spreadsheetId=SPREADSHEET_ID,
                 range='Sheet1!A2:H'
-            ).execute()
+            ))
             
             values = result.get('values', [])
             users = []
@@ -206,16 +482,19 @@ class SheetsManager:
     async def get_user_stats(self, user_id):
         """Получает статистику пользователя"""
         try:
-            # Получаем данные из основной таблицы
-            result = self.sheet.values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range='Sheet1!A:H'
-            ).execute()
-            
-            values = result.get('values', [])
+            # Получаем строку пользователя из основной таблицы по индексу
+            if self._row_index is None:
+                await self._rebuild_row_index()
             user_data = None
-            for row in values:
-                if row[0] == str(user_id):
+            user_row = self._row_index.get(str(user_id))
+            if user_row:
+                result = await self._execute(self.sheet.values().get(
+                    spreadsheetId=SPREADSHEET_ID,
+                    range=f'Sheet1!A{user_row}:H{user_row}'
+                ))
+                values = result.get('values', [])
+                if values:
+                    row = values[0] + [''] * (8 - len(values[0]))
                     user_data = {
                         'name': row[1],
                         'start_date': row[2],
@@ -225,27 +504,10 @@ class SheetsManager:
                         'marathon_day': row[6],
                         'status': row[7]
                     }
-                    break
 
-            # Получаем последние активности
-            result = self.sheet.values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range='Daily Reports!A:N'
-            ).execute()
-            
-            values = result.get('values', [])
-            activities = []
-            for row in values:
-                if row[1] == str(user_id):
-                    activities.append({
-                        'date': row[0],
-                        'meals': row[3:9],
-                        'cardio': row[9],
-                        'strength': row[10],
-                        'weight': row[11],
-                        'progress': row[12],
-                        'comments': row[13]
-                    })
+            # Последние активности берём из локальной копии листа отчётов
+            await self._sync_reports()
+            activities = self._reports_by_user.get(str(user_id), [])
 
             return {
                 'user_data': user_data,
@@ -254,4 +516,4 @@ class SheetsManager:
 
         except HttpError as error:
             print(f"An error occurred: {error}")
-            return None 
\ No newline at end of file
+            return None
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional
+from data_manager import data_manager, DataManager
+
+MARATHON_DAYS = 90  # Длительность марафона в днях
+# Сколько готовых сообщений статистики держим в памяти
+RENDER_CACHE_SIZE = 2048
+
+def _build_progress_grid(progress: int) -> str:
+    """Квадратики прогресса: пройденные дни зелёные, по 10 в строке"""
+    rows = []
+    for start in range(0, MARATHON_DAYS, 10):
+        rows.append(''.join(
+            "🟩" if day < progress else "⬜️"
+            for day in range(start, start + 10)
+        ))
+    return "\n".join(rows) + "\n"
+
+# Все возможные сетки прогресса: от 0 до 90 пройденных дней
+PROGRESS_GRIDS = [_build_progress_grid(progress) for progress in range(MARATHON_DAYS + 1)]
+
+def progress_grid(progress: int) -> str:
+    """Готовая сетка прогресса для числа пройденных дней"""
+    return PROGRESS_GRIDS[max(0, min(progress, MARATHON_DAYS))]
+
+def render_stats_message(stats: Dict) -> str:
+    """Текст статистики участника"""
+    parts = [
+        f"📊 День {stats['marathon_progress']} из 90\n\n",
+        progress_grid(stats['marathon_progress']),
+        f"\n⏳ Осталось: {stats['days_left']} дней\n\n",
+        "⚖️ Твой путь к прессу:\n"
+    ]
+
+    if stats['current_weight'] is not None:
+        parts.append(
+            f"Стартовый вес: {stats['start_weight']:.1f} кг\n"
+            f"Текущий вес: {stats['current_weight']:.1f} кг\n"
+            f"Изменение: {stats['weight_diff']:+.1f} кг\n"
+        )
+        parts.append("🔥 Жир горит!\n" if stats['weight_diff'] <= 0 else "💪 Время поднажать!\n")
+    else:
+        parts.append("⚖️ Пока нет данных о весе\n")
+
+    parts.append("\nСегодняшние подвиги:\n")
+    parts.append(f"🍽 Приёмы пищи: {stats['today_meals']}/5\n")
+    parts.append("🏃‍♂️ Кардио: ✅ 🔥\n" if stats['today_cardio'] else "🏃‍♂️ Кардио: ❌\n")
+    parts.append("💪 Силовая: ✅ 💪\n" if stats['today_strength'] else "💪 Силовая: ❌\n")
+
+    if stats['today_meals'] == 5 and stats['today_cardio'] and stats['today_strength']:
+        parts.append("\n💪 Ты просто космос! Так держать! 🚀")
+    elif stats['today_meals'] > 0 or stats['today_cardio'] or stats['today_strength']:
+        parts.append("\n💪 Продолжай в том же духе!")
+    else:
+        parts.append("\n💪 Давай начнем этот день правильно!")
+    return ''.join(parts)
+
+class StatsRenderCache:
+    """Готовые сообщения статистики по ключу (пользователь, дата, версия данных)
+
+    Запись пользователя сбрасывается, как только DataManager сообщает об изменении
+    его данных, а версия в ключе защищает от гонки между чтением и записью.
+    Изменения из другого процесса замечаются, когда DataManager перечитывает запись.
+    """
+
+    def __init__(self, manager: DataManager, max_entries: int = RENDER_CACHE_SIZE):
+        self.manager = manager
+        self.max_entries = max_entries
+        # user_id -> (дата, версия данных, сообщение)
+        self._entries: OrderedDict = OrderedDict()
+        manager.add_listener(self.invalidate)
+
+    def invalidate(self, user_id: str):
+        """Сбрасывает готовое сообщение пользователя"""
+        self._entries.pop(user_id, None)
+
+    def get(self, user_id: str, date: Optional[str] = None) -> str:
+        """Сообщение статистики за день (по умолчанию - за сегодня пользователя)"""
+        date = date or self.manager.user_local_date(user_id)
+        version = self.manager.data_version(user_id)
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] == date and entry[1] == version:
+            self._entries.move_to_end(user_id)
+            return entry[2]
+
+        message = render_stats_message(self.manager.get_user_stats(user_id, date))
+        self._entries[user_id] = (date, version, message)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return message
+
+# Общий кэш сообщений статистики
+stats_cache = StatsRenderCache(data_manager)
@@ -0,0 +1,475 @@
+import json
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import logging
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Сколько строк может накопиться в журнале пользователя до фонового уплотнения
+COMPACT_THRESHOLD = 200
+
+
+class JsonStorage:
+    """Хранение записи пользователя целиком в одном JSON-файле"""
+
+    # Умеет ли хранилище отвечать на сводные запросы без чтения всех записей
+    indexed = False
+
+    def __init__(self, users_dir: str):
+        self.users_dir = users_dir
+        os.makedirs(self.users_dir, exist_ok=True)
+
+    def get_user_data_file(self, user_id: str) -> str:
+        """Возвращает путь к файлу с данными пользователя"""
+        return os.path.join(self.users_dir, f"{user_id}.json")
+
+    def _mtime(self, file_path: str) -> Optional[int]:
+        """Возвращает mtime файла или None, если файла нет"""
+        try:
+            return os.stat(file_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def version(self, user_id: str):
+        """Метка версии данных на диске (None, если данных нет)"""
+        return self._mtime(self.get_user_data_file(user_id))
+
+    def list_user_ids(self) -> List[str]:
+        """Возвращает ID всех пользователей, для которых есть данные"""
+        return [
+            filename[:-5]  # Убираем .json
+            for filename in os.listdir(self.users_dir)
+            if filename.endswith('.json')
+        ]
+
+    def load(self, user_id: str) -> Optional[Dict]:
+        """Загружает запись пользователя или возвращает None"""
+        file_path = self.get_user_data_file(user_id)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, user_id: str, data: Dict, appended: Optional[List[Tuple[str, Dict]]] = None):
+        """Сохраняет запись пользователя
+
+        appended - записи активностей, добавленные с прошлого сохранения.
+        Этому хранилищу они не нужны: файл всегда переписывается целиком.
+        """
+        os.makedirs(self.users_dir, exist_ok=True)
+        self._write_json(self.get_user_data_file(user_id), data)
+
+    def _write_json(self, file_path: str, data: Dict):
+        """Атомарно записывает JSON: во временный файл рядом и переименование поверх
+
+        Читатель видит либо старую, либо новую версию файла, но не половину записи.
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(file_path), prefix=os.path.basename(file_path) + '.', suffix='.tmp'
+        )
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def spec(self) -> Tuple[type, tuple]:
+        """Класс и аргументы, чтобы открыть это же хранилище в другом процессе"""
+        return JsonStorage, (self.users_dir,)
+
+    def close(self):
+        """Освобождает ресурсы хранилища"""
+
+
+class EventLogStorage(JsonStorage):
+    """Снимок записи в JSON плюс журнал добавленных активностей в JSON-lines
+
+    Активности только дописываются в конец <user_id>.log.jsonl, поэтому
+    стоимость записи не зависит от длины истории. Журнал периодически
+    уплотняется в снимок <user_id>.json фоновым потоком. Каждая строка журнала
+    несёт порядковый номер, а снимок помнит последний учтённый номер, так что
+    сбой посреди уплотнения не приводит к задвоению записей.
+    """
+
+    SEQ_KEY = '_log_seq'
+
+    def __init__(self, users_dir: str, compact_threshold: int = COMPACT_THRESHOLD):
+        super().__init__(users_dir)
+        self.compact_threshold = compact_threshold
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        self._seq: Dict[str, int] = {}  # Последний номер строки журнала
+        self._log_lines: Dict[str, int] = {}  # Строк в журнале после снимка
+        self._compact_queue: queue.Queue = queue.Queue()
+        self._compactor = threading.Thread(target=self._compact_worker, name='log-compactor', daemon=True)
+        self._compactor.start()
+
+    def get_log_file(self, user_id: str) -> str:
+        """Возвращает путь к журналу активностей пользователя"""
+        return os.path.join(self.users_dir, f"{user_id}.log.jsonl")
+
+    def _lock(self, user_id: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(user_id, threading.Lock())
+
+    def version(self, user_id: str):
+        snapshot = self._mtime(self.get_user_data_file(user_id))
+        if snapshot is None:
+            return None
+        return snapshot, self._mtime(self.get_log_file(user_id))
+
+    def _read(self, user_id: str) -> Tuple[Optional[Dict], int, int]:
+        """Читает снимок и проигрывает журнал: (данные, последний номер, строк в журнале)"""
+        file_path = self.get_user_data_file(user_id)
+        if not os.path.exists(file_path):
+            return None, 0, 0
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        seq = data.pop(self.SEQ_KEY, 0)
+
+        log_lines = 0
+        log_path = self.get_log_file(user_id)
+        if os.path.exists(log_path):
+            with open(log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # Недописанная строка после сбоя
+                        logger.warning(f"Пропущена повреждённая строка журнала пользователя {user_id}")
+                        continue
+                    if event['seq'] <= seq:
+                        continue
+                    data.setdefault(event['field'], []).append(event['entry'])
+                    seq = event['seq']
+                    log_lines += 1
+        if log_lines:
+            # Счётчики по дням в снимке не учитывают журнал - их пересчитает DataManager
+            data.pop('daily', None)
+        return data, seq, log_lines
+
+    def load(self, user_id: str) -> Optional[Dict]:
+        with self._lock(user_id):
+            data, seq, log_lines = self._read(user_id)
+            if data is not None:
+                self._seq[user_id] = seq
+                self._log_lines[user_id] = log_lines
+            return data
+
+    def _write_snapshot(self, user_id: str, data: Dict, seq: int):
+        """Атомарно записывает снимок и удаляет учтённый в нём журнал"""
+        self._write_json(self.get_user_data_file(user_id), {**data, self.SEQ_KEY: seq})
+        try:
+            os.remove(self.get_log_file(user_id))
+        except FileNotFoundError:
+            pass
+        self._seq[user_id] = seq
+        self._log_lines[user_id] = 0
+
+    def save(self, user_id: str, data: Dict, appended: Optional[List[Tuple[str, Dict]]] = None):
+        """Дописывает новые активности в журнал или переписывает снимок целиком"""
+        with self._lock(user_id):
+            if user_id not in self._seq:
+                # Номер последней строки ещё не известен - читаем его с диска
+                _, self._seq[user_id], self._log_lines[user_id] = self._read(user_id)
+
+            if appended is None or not os.path.exists(self.get_user_data_file(user_id)):
+                self._write_snapshot(user_id, data, self._seq[user_id])
+                return
+
+            seq = self._seq[user_id]
+            lines = []
+            for field, entry in appended:
+                seq += 1
+                lines.append(json.dumps({'seq': seq, 'field': field, 'entry': entry},
+                                        ensure_ascii=False, separators=(',', ':')))
+            with open(self.get_log_file(user_id), 'a', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            self._seq[user_id] = seq
+            self._log_lines[user_id] += len(lines)
+
+            if self._log_lines[user_id] >= self.compact_threshold:
+                self._compact_queue.put(user_id)
+
+    def compact(self, user_id: str):
+        """Сворачивает журнал пользователя в снимок"""
+        with self._lock(user_id):
+            data, seq, log_lines = self._read(user_id)
+            if data is None or log_lines == 0:
+                return
+            self._write_snapshot(user_id, data, seq)
+
+    def _compact_worker(self):
+        """Фоновый поток уплотнения журналов"""
+        while True:
+            user_id = self._compact_queue.get()
+            if user_id is None:
+                break
+            try:
+                self.compact(user_id)
+            except Exception as e:
+                logger.error(f"Ошибка при уплотнении журнала пользователя {user_id}: {e}")
+
+    def spec(self) -> Tuple[type, tuple]:
+        return EventLogStorage, (self.users_dir, self.compact_threshold)
+
+    def close(self):
+        self._compact_queue.put(None)
+        self._compactor.join(timeout=5)
+
+
+class SqliteStorage(JsonStorage):
+    """Хранение данных участников в SQLite
+
+    Каждый вид активности лежит в своей таблице с индексами по (user_id, date),
+    поэтому сводки за день считаются агрегатами SQL, а не чтением всех записей.
+    """
+
+    indexed = True
+
+    # Поле записи пользователя -> (таблица, колонка со значением)
+    ACTIVITY_TABLES = {
+        'meals': ('meals', 'photo_id'),
+        'cardio': ('cardio', 'duration'),
+        'strength': ('strength', 'exercises'),
+        'weight_history': ('weights', 'weight'),
+    }
+    USER_COLUMNS = ('user_id', 'name', 'start_date', 'delivery_status')
+    # Производные поля: не храним, DataManager пересчитывает их при загрузке
+    DERIVED_FIELDS = ('daily',)
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.users_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(self.users_dir, exist_ok=True)
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self._create_schema()
+
+    def _create_schema(self):
+        with self._lock, self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS users ('
+                'user_id TEXT PRIMARY KEY, name TEXT, start_date TEXT, '
+                'extra TEXT, version INTEGER NOT NULL DEFAULT 0)'
+            )
+            # Колонки, добавленные после первой версии схемы
+            columns = {row[1] for row in self.conn.execute('PRAGMA table_info(users)')}
+            if 'delivery_status' not in columns:
+                self.conn.execute('ALTER TABLE users ADD COLUMN delivery_status TEXT')
+            for table, column in self.ACTIVITY_TABLES.values():
+                self.conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS {table} ('
+                    f'id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, '
+                    f'date TEXT NOT NULL, {column})'
+                )
+                self.conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_user_date ON {table} (user_id, date)')
+                # Для сводок «кто что сделал за день» по всем участникам
+                self.conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_date ON {table} (date)')
+
+    def get_user_data_file(self, user_id: str) -> str:
+        return self.db_path
+
+    def version(self, user_id: str):
+        with self._lock:
+            row = self.conn.execute('SELECT version FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def list_user_ids(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self.conn.execute('SELECT user_id FROM users')]
+
+    def load(self, user_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self.conn.execute(
+                f'SELECT extra, {", ".join(self.USER_COLUMNS)} FROM users WHERE user_id = ?', (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            data = json.loads(row[0]) if row[0] else {}
+            data.update(zip(self.USER_COLUMNS[:3], row[1:4]))
+            if row[4]:
+                data['delivery_status'] = row[4]
+            for field, (table, column) in self.ACTIVITY_TABLES.items():
+                data[field] = [
+                    {'date': date, column: value}
+                    for date, value in self.conn.execute(
+                        f'SELECT date, {column} FROM {table} WHERE user_id = ? ORDER BY id', (user_id,)
+                    )
+                ]
+            return data
+
+    def _insert_entries(self, user_id: str, field: str, entries: List[Dict]):
+        table, column = self.ACTIVITY_TABLES[field]
+        self.conn.executemany(
+            f'INSERT INTO {table} (user_id, date, {column}) VALUES (?, ?, ?)',
+            [(user_id, entry['date'], entry.get(column)) for entry in entries]
+        )
+
+    def save(self, user_id: str, data: Dict, appended: Optional[List[Tuple[str, Dict]]] = None):
+        """Добавляет новые активности или переписывает данные пользователя целиком"""
+        with self._lock, self.conn:
+            exists = self.conn.execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            if appended is not None and exists:
+                for field, entry in appended:
+                    if field in self.ACTIVITY_TABLES:
+                        self._insert_entries(user_id, field, [entry])
+                self.conn.execute('UPDATE users SET version = version + 1 WHERE user_id = ?', (user_id,))
+                return
+
+            extra = {
+                key: value for key, value in data.items()
+                if key not in self.USER_COLUMNS and key not in self.ACTIVITY_TABLES
+                and key not in self.DERIVED_FIELDS
+            }
+            columns = self.USER_COLUMNS[1:]
+            self.conn.execute(
+                f'INSERT INTO users (user_id, extra, {", ".join(columns)}) '
+                f'VALUES (?, ?, {", ".join("?" for _ in columns)}) '
+                f'ON CONFLICT(user_id) DO UPDATE SET extra = excluded.extra, version = version + 1, '
+                + ', '.join(f'{column} = excluded.{column}' for column in columns),
+                (user_id, json.dumps(extra, ensure_ascii=False), *(data.get(column) for column in columns))
+            )
+            for field, (table, _) in self.ACTIVITY_TABLES.items():
+                self.conn.execute(f'DELETE FROM {table} WHERE user_id = ?', (user_id,))
+                self._insert_entries(user_id, field, data.get(field, []))
+
+    def list_users(self, include_unreachable: bool = False) -> List[Dict]:
+        """Участники с именами без чтения их активностей"""
+        query = "SELECT user_id, name, start_date, delivery_status FROM users WHERE name IS NOT NULL AND name != ''"
+        if not include_unreachable:
+            query += ' AND delivery_status IS NULL'
+        with self._lock:
+            return [
+                {'user_id': user_id, 'name': name, 'start_date': start_date, 'delivery_status': status}
+                for user_id, name, start_date, status in self.conn.execute(query)
+            ]
+
+    def day_activity(self, date: str) -> Dict[str, Dict]:
+        """Счётчики всех участников за день: user_id -> {meals, cardio, cardio_minutes, strength, weight}"""
+        # Даты хранятся строками, начинающимися с YYYY-MM-DD
+        bounds = (date, date + '\uffff')
+        activity: Dict[str, Dict] = {}
+
+        def day(user_id: str) -> Dict:
+            return activity.setdefault(
+                user_id, {'meals': 0, 'cardio': 0, 'cardio_minutes': 0, 'strength': 0, 'weight': None}
+            )
+
+        with self._lock:
+            for field in ('meals', 'strength'):
+                table, _ = self.ACTIVITY_TABLES[field]
+                for user_id, count in self.conn.execute(
+                    f'SELECT user_id, COUNT(*) FROM {table} WHERE date BETWEEN ? AND ? GROUP BY user_id', bounds
+                ):
+                    day(user_id)[field] = count
+            for user_id, count, minutes in self.conn.execute(
+                'SELECT user_id, COUNT(*), COALESCE(SUM(duration), 0) FROM cardio '
+                'WHERE date BETWEEN ? AND ? GROUP BY user_id', bounds
+            ):
+                day(user_id).update(cardio=count, cardio_minutes=minutes)
+            # Вес за день - последний внесённый
+            for user_id, weight in self.conn.execute(
+                'SELECT w.user_id, w.weight FROM weights w JOIN ('
+                'SELECT MAX(id) AS id FROM weights WHERE date BETWEEN ? AND ? GROUP BY user_id'
+                ') last ON w.id = last.id', bounds
+            ):
+                day(user_id)['weight'] = weight
+        return activity
+
+    def weight_bounds(self) -> Dict[str, Tuple[float, float]]:
+        """Первый и последний вес каждого участника: user_id -> (первый, последний)"""
+        with self._lock:
+            return {
+                user_id: (first, last)
+                for user_id, first, last in self.conn.execute(
+                    'SELECT b.user_id, f.weight, l.weight FROM ('
+                    'SELECT user_id, MIN(id) AS first_id, MAX(id) AS last_id FROM weights GROUP BY user_id'
+                    ') b JOIN weights f ON f.id = b.first_id JOIN weights l ON l.id = b.last_id'
+                )
+            }
+
+    def activity_counts(self, date_from: str, date_to: str,
+                        user_ids: Optional[List[str]] = None) -> Dict[str, List]:
+        """Число активностей по участникам, дням и видам за период - колонками
+
+        user_ids - только эти участники (по умолчанию все).
+        """
+        params = [date_from, date_to + '\uffff']
+        user_filter = ''
+        if user_ids is not None:
+            user_filter = f' AND user_id IN ({", ".join("?" * len(user_ids))})'
+            params += list(user_ids)
+        columns: Dict[str, List] = {'user_id': [], 'date': [], 'kind': [], 'count': []}
+        with self._lock:
+            for field, (table, _) in self.ACTIVITY_TABLES.items():
+                for user_id, date, count in self.conn.execute(
+                    f'SELECT user_id, substr(date, 1, 10) AS day, COUNT(*) FROM {table} '
+                    f'WHERE date BETWEEN ? AND ?{user_filter} GROUP BY user_id, day', params
+                ):
+                    columns['user_id'].append(user_id)
+                    columns['date'].append(date)
+                    columns['kind'].append(field)
+                    columns['count'].append(count)
+        return columns
+
+    def activity_totals(self) -> Dict[str, Dict]:
+        """Число активностей каждого вида за всё время: user_id -> {meals, cardio, strength}"""
+        totals: Dict[str, Dict] = {}
+        with self._lock:
+            for field in ('meals', 'cardio', 'strength'):
+                table, _ = self.ACTIVITY_TABLES[field]
+                for user_id, count in self.conn.execute(
+                    f'SELECT user_id, COUNT(*) FROM {table} GROUP BY user_id'
+                ):
+                    totals.setdefault(user_id, {'meals': 0, 'cardio': 0, 'strength': 0})[field] = count
+        return totals
+
+    def spec(self) -> Tuple[type, tuple]:
+        return SqliteStorage, (self.db_path,)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+def migrate_json_to_sqlite(users_dir: str, db_path: str) -> int:
+    """Переносит data/users/*.json (вместе с журналами) в SQLite, возвращает число участников"""
+    source = EventLogStorage(users_dir)
+    target = SqliteStorage(db_path)
+    migrated = 0
+    try:
+        for user_id in source.list_user_ids():
+            data = source.load(user_id)
+            if data is None:
+                continue
+            target.save(user_id, data)
+            migrated += 1
+    finally:
+        source.close()
+        target.close()
+    return migrated
+
+
+def create_storage(users_dir: str) -> JsonStorage:
+    """Создаёт хранилище, выбранное переменной окружения DATA_STORAGE"""
+    backend = os.getenv('DATA_STORAGE', 'json')
+    if backend == 'eventlog':
+        return EventLogStorage(users_dir)
+    if backend == 'sqlite':
+        db_path = os.getenv('DATA_SQLITE_PATH') or os.path.join(os.path.dirname(users_dir), 'fit.db')
+        return SqliteStorage(db_path)
+    if backend != 'json':
+        logger.warning(f"Неизвестное хранилище {backend}, используется json")
+    return JsonStorage(users_dir)
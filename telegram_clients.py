@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from typing import Dict
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Размер пула HTTP-соединений общего клиента
+CONNECTION_POOL_SIZE = 8
+
+# Общие клиенты Bot API: токен -> инициализированный Bot
+_bots: Dict[str, Bot] = {}
+# Клиенты приложений, запущенных в этом процессе: ими владеют приложения, здесь не закрываем
+_app_bots: Dict[str, Bot] = {}
+_init_lock = asyncio.Lock()
+
+def register_bot(bot: Bot):
+    """Регистрирует клиент приложения, запущенного в этом же процессе
+
+    После этого get_bot() для его токена возвращает этот клиент, и отдельное
+    соединение для второго бота не создаётся.
+    """
+    _app_bots[bot.token] = bot
+
+def unregister_bot(bot: Bot):
+    """Убирает клиент остановленного приложения"""
+    if _app_bots.get(bot.token) is bot:
+        del _app_bots[bot.token]
+
+async def get_bot(token: str) -> Bot:
+    """Возвращает общий клиент Bot API для токена, создавая его при первом обращении"""
+    bot = _app_bots.get(token) or _bots.get(token)
+    if bot is not None:
+        return bot
+    
+    async with _init_lock:
+        bot = _bots.get(token)
+        if bot is None:
+            bot = Bot(token, request=HTTPXRequest(connection_pool_size=CONNECTION_POOL_SIZE))
+            await bot.initialize()
+            _bots[token] = bot
+            logger.info(f"Создан общий клиент бота @{bot.username}")
+    return bot
+
+async def close_bots():
+    """Закрывает все общие клиенты (вызывается при остановке приложения)"""
+    for bot in list(_bots.values()):
+        try:
+            await bot.shutdown()
+        except Exception as e:
+            logger.error(f"Ошибка при закрытии клиента бота: {e}")
+    _bots.clear()
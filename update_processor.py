@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+import time
+import weakref
+from collections import deque
+from typing import Any, Awaitable, Dict, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Сколько обработчиков могут выполняться одновременно
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '8'))
+# Сколько обновлений может ждать своей очереди, прежде чем приём новых притормозит
+UPDATE_BACKLOG = int(os.getenv('UPDATE_BACKLOG', '1000'))
+# Как часто писать метрики в лог, секунд (0 - не писать)
+UPDATE_METRICS_INTERVAL = float(os.getenv('UPDATE_METRICS_INTERVAL', '300'))
+# По скольким последним обновлениям считаем задержки
+LATENCY_WINDOW = 1000
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений: разные чаты - одновременно, один чат - по порядку
+
+    Обновление сначала ждёт своей очереди в чате, а потом свободного воркера,
+    поэтому несколько сообщений одного пользователя не занимают чужие воркеры.
+    """
+
+    def __init__(self, workers: int = UPDATE_WORKERS, backlog: int = UPDATE_BACKLOG,
+                 metrics_interval: float = UPDATE_METRICS_INTERVAL):
+        # Семафор базового класса ограничивает число принятых, но не завершённых обновлений
+        super().__init__(max_concurrent_updates=workers + backlog)
+        self.workers = workers
+        self.metrics_interval = metrics_interval
+        self._workers = asyncio.Semaphore(workers)
+        # Очереди чатов: chat_id -> замок, живёт, пока в чате есть обновления
+        self._chat_locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+        self._waiting = 0
+        self._running = 0
+        self._processed = 0
+        self._failed = 0
+        self._max_waiting = 0
+        self._wait_times: deque = deque(maxlen=LATENCY_WINDOW)
+        self._handle_times: deque = deque(maxlen=LATENCY_WINDOW)
+        self._reporter: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[int]:
+        """Ключ очереди: чат, а если его нет (inline-запросы) - пользователь"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    def _chat_lock(self, key) -> asyncio.Lock:
+        lock = self._chat_locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._chat_locks[key] = lock
+        return lock
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """Ждёт очереди чата и свободного воркера, затем выполняет обработчики"""
+        received = time.monotonic()
+        key = self._chat_key(update)
+        chat_lock = self._chat_lock(key) if key is not None else None
+        self._waiting += 1
+        self._max_waiting = max(self._max_waiting, self._waiting)
+        waiting = True
+        try:
+            if chat_lock is not None:
+                await chat_lock.acquire()
+            try:
+                async with self._workers:
+                    self._waiting -= 1
+                    waiting = False
+                    self._running += 1
+                    started = time.monotonic()
+                    self._wait_times.append(started - received)
+                    try:
+                        await coroutine
+                    except Exception:
+                        self._failed += 1
+                        raise
+                    finally:
+                        self._running -= 1
+                        self._processed += 1
+                        self._handle_times.append(time.monotonic() - started)
+            finally:
+                if chat_lock is not None:
+                    chat_lock.release()
+        finally:
+            if waiting:
+                # Отменено до начала обработки
+                self._waiting -= 1
+
+    @staticmethod
+    def _percentile(values, share: float) -> float:
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+    def metrics(self) -> Dict:
+        """Глубина очереди и задержки обработки (в секундах, по последним обновлениям)"""
+        return {
+            'waiting': self._waiting,
+            'running': self._running,
+            'max_waiting': self._max_waiting,
+            'processed': self._processed,
+            'failed': self._failed,
+            'wait_avg': round(sum(self._wait_times) / len(self._wait_times), 3) if self._wait_times else 0.0,
+            'wait_p95': round(self._percentile(self._wait_times, 0.95), 3),
+            'handle_avg': round(sum(self._handle_times) / len(self._handle_times), 3) if self._handle_times else 0.0,
+            'handle_p95': round(self._percentile(self._handle_times, 0.95), 3),
+            'handle_max': round(max(self._handle_times), 3) if self._handle_times else 0.0
+        }
+
+    def log_metrics(self):
+        """Пишет метрики в лог и сбрасывает максимум очереди за период"""
+        m = self.metrics()
+        logger.info(
+            f"Обновления: ждут {m['waiting']} (макс. {m['max_waiting']}), выполняются {m['running']}/{self.workers}, "
+            f"обработано {m['processed']}, с ошибкой {m['failed']}; "
+            f"ожидание {m['wait_avg']}/{m['wait_p95']} с, обработка {m['handle_avg']}/{m['handle_p95']} с "
+            f"(среднее/p95), макс. {m['handle_max']} с"
+        )
+        self._max_waiting = self._waiting
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            self.log_metrics()
+
+    async def initialize(self) -> None:
+        if self.metrics_interval > 0 and self._reporter is None:
+            self._reporter = asyncio.create_task(self._report_loop())
+
+    async def shutdown(self) -> None:
+        if self._reporter is not None:
+            self._reporter.cancel()
+            try:
+                await self._reporter
+            except asyncio.CancelledError:
+                pass
+            self._reporter = None
+        self.log_metrics()
@@ -1,8 +1,13 @@
 import os
+import threading
 from datetime import datetime
 import gspread
+from gspread.utils import ValueRenderOption, a1_to_rowcol
 from oauth2client.service_account import ServiceAccountCredentials
-from typing import Dict, List
+from typing import Dict, List, Optional
+
+SPREADSHEET_NAME = 'FitnessTracking'
+REPORTS_WORKSHEET = 'DailyReports'
 
 class DataManager:
     def __init__(self):
@@ -11,26 +16,115 @@ class DataManager:
         creds = ServiceAccountCredentials.from_json_keyfile_name(
             'credentials.json', scope)
         self.client = gspread.authorize(creds)
-        
+        # Таблица и листы открываются один раз: open() по имени - это поиск в Drive
+        self._spreadsheet = None
+        self._worksheets: Dict[str, gspread.Worksheet] = {}
+        # Индекс истории веса: user_id -> [{'date', 'weight'}], и сколько строк листа уже прочитано
+        self._weights: Dict[str, List[Dict]] = {}
+        self._weight_rows = 0
+        # Отчёты по датам: дата -> [строка отчёта]
+        self._reports: Dict[str, List[Dict]] = {}
+        self._report_rows = 0
+        self._lock = threading.RLock()
+
+    @property
+    def spreadsheet(self) -> gspread.Spreadsheet:
+        """Открытая таблица (кэшируется)"""
+        if self._spreadsheet is None:
+            self._spreadsheet = self.client.open(SPREADSHEET_NAME)
+        return self._spreadsheet
+
+    def worksheet(self, name: Optional[str] = None) -> gspread.Worksheet:
+        """Лист таблицы по имени, None - первый лист (кэшируется)"""
+        key = name or ''
+        if key not in self._worksheets:
+            self._worksheets[key] = (
+                self.spreadsheet.worksheet(name) if name else self.spreadsheet.sheet1
+            )
+        return self._worksheets[key]
+
+    @staticmethod
+    def _read_rows(sheet: gspread.Worksheet, known_rows: int, last_column: str) -> List[List]:
+        """Читает только строки после уже прочитанных known_rows"""
+        first_row = known_rows + 1
+        try:
+            return sheet.get(
+                f'A{first_row}:{last_column}',
+                value_render_option=ValueRenderOption.unformatted
+            )
+        except gspread.exceptions.APIError as e:
+            # Лист заполнен ровно до конца сетки: диапазон за последней строкой
+            # API отвергает - значит, новых строк нет
+            if 'exceeds grid limits' in str(e):
+                return []
+            raise
+
+    @staticmethod
+    def _appended_row(result: Dict) -> int:
+        """Номер первой строки, в которую легла дописанная запись"""
+        updated_range = result['updates']['updatedRange'].split('!')[-1]
+        return a1_to_rowcol(updated_range.split(':')[0])[0]
+
+    def _sync_weights(self) -> None:
+        """Дочитывает новые строки листа веса в индекс"""
+        rows = self._read_rows(self.worksheet(), self._weight_rows, 'C')
+        if self._weight_rows == 0 and rows:
+            # Заголовок
+            rows = rows[1:]
+            self._weight_rows = 1
+        for row in rows:
+            self._add_weight(row)
+        self._weight_rows += len(rows)
+
+    def _add_weight(self, row: List) -> None:
+        if len(row) < 3:
+            return
+        self._weights.setdefault(str(row[1]), []).append({'date': row[0], 'weight': row[2]})
+
+    def _sync_reports(self) -> None:
+        """Дочитывает новые строки листа отчётов в индекс по датам"""
+        rows = self._read_rows(self.worksheet(REPORTS_WORKSHEET), self._report_rows, 'G')
+        if self._report_rows == 0 and rows:
+            # Заголовок
+            rows = rows[1:]
+            self._report_rows = 1
+        for row in rows:
+            self._add_report(row)
+        self._report_rows += len(rows)
+
+    def _add_report(self, row: List) -> None:
+        if len(row) < 2:
+            return
+        row = list(row) + [''] * (7 - len(row))
+        self._reports.setdefault(str(row[0]), []).append({
+            'date': row[0],
+            'user_id': row[1],
+            'meals': row[2],
+            'cardio': row[3],
+            'strength': row[4],
+            'water': row[5],
+            'mood': row[6]
+        })
+
     def save_weight(self, user_id: int, weight: float) -> None:
         """Сохранение веса пользователя"""
-        sheet = self.client.open('FitnessTracking').sheet1
         date = datetime.now().strftime('%Y-%m-%d')
-        sheet.append_row([date, user_id, weight])
-        
+        row = [date, user_id, weight]
+        with self._lock:
+            result = self.worksheet().append_row(row)
+            # Своя строка сразу попадает в индекс, если легла сразу за прочитанными
+            if self._weight_rows and self._appended_row(result) == self._weight_rows + 1:
+                self._add_weight(row)
+                self._weight_rows += 1
+
     def get_weight_history(self, user_id: int) -> List[Dict]:
         """Получение истории веса пользователя"""
-        sheet = self.client.open('FitnessTracking').sheet1
-        data = sheet.get_all_records()
-        return [
-            {'date': row['date'], 'weight': row['weight']}
-            for row in data
-            if row['user_id'] == user_id
-        ]
-        
+        with self._lock:
+            self._sync_weights()
+            return list(self._weights.get(str(user_id), []))
+
     def save_daily_report(self, user_id: int, report_data: Dict) -> None:
         """Сохранение дневного отчета"""
-        sheet = self.client.open('FitnessTracking').worksheet('DailyReports')
         date = datetime.now().strftime('%Y-%m-%d')
         row = [
             date,
@@ -41,36 +135,40 @@ class DataManager:
             report_data.get('water', 0),
             report_data.get('mood', '')
         ]
-        sheet.append_row(row)
+        with self._lock:
+            result = self.worksheet(REPORTS_WORKSHEET).append_row(row)
+            if self._report_rows and self._appended_row(result) == self._report_rows + 1:
+                self._add_report(row)
+                self._report_rows += 1
+
+    def get_daily_reports(self, date: str) -> List[Dict]:
+        """Отчёты всех пользователей за дату"""
+        with self._lock:
+            self._sync_reports()
+            return list(self._reports.get(date, []))
 
 class AdminPanel:
     def __init__(self, data_manager: DataManager):
         self.data_manager = data_manager
-        
+
     def get_user_stats(self, user_id: int) -> Dict:
         """Получение статистики пользователя"""
         weight_history = self.data_manager.get_weight_history(user_id)
         if not weight_history:
             return {}
-            
+
         latest_weight = weight_history[-1]['weight']
         initial_weight = weight_history[0]['weight']
         weight_diff = latest_weight - initial_weight
-        
+
         return {
             'current_weight': latest_weight,
             'total_loss': abs(weight_diff) if weight_diff < 0 else 0,
             'total_gain': weight_diff if weight_diff > 0 else 0,
             'weight_history': weight_history
         }
-        
+
     def get_daily_summary(self) -> List[Dict]:
         """Получение сводки за день по всем пользователям"""
-        sheet = self.client.open('FitnessTracking').worksheet('DailyReports')
         today = datetime.now().strftime('%Y-%m-%d')
-        data = sheet.get_all_records()
-        
-        return [
-            row for row in data
-            if row['date'] == today
-        ] 
\ No newline at end of file
+        return self.data_manager.get_daily_reports(today)
@@ -0,0 +1,105 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import signal
+from typing import Dict
+from aiohttp import web
+from dotenv import load_dotenv
+from telegram import Update
+from telegram.ext import Application
+import bot
+import admin_bot
+from run_all import start_applications, stop_applications
+
+# Загрузка переменных окружения
+load_dotenv()
+# Публичный адрес сервера (https://example.com); пустой - вебхуки в Telegram не регистрируются,
+# удобно для локальной проверки: обновления можно слать на сервер самому
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_BOT_PATH = os.getenv('WEBHOOK_BOT_PATH', '/bot')
+WEBHOOK_ADMIN_PATH = os.getenv('WEBHOOK_ADMIN_PATH', '/admin')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+def make_webhook_handler(application: Application, secret: str):
+    """Обработчик POST-запросов от Telegram для одного приложения"""
+    async def handle(request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(token.encode(), secret.encode()):
+            logger.warning(f"Запрос на {request.path} с неверным секретом от {request.remote}")
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            if not isinstance(data, dict):
+                raise ValueError('тело запроса - не JSON-объект')
+            update = Update.de_json(data, application.bot)
+        except (json.JSONDecodeError, ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warning(f"Некорректное обновление на {request.path}: {e}")
+            return web.Response(status=400)
+        if update is None:
+            return web.Response(status=400)
+        # Отвечаем сразу: обновление обрабатывается приложением в фоне
+        await application.update_queue.put(update)
+        return web.Response()
+    return handle
+
+def create_web_app(applications: Dict[str, Application], secret: str) -> web.Application:
+    """aiohttp-приложение: путь -> приложение бота"""
+    web_app = web.Application()
+    for path, application in applications.items():
+        web_app.router.add_post(path, make_webhook_handler(application, secret))
+    return web_app
+
+async def register_webhooks(applications: Dict[str, Application], secret: str):
+    """Регистрирует вебхуки ботов в Telegram"""
+    for path, application in applications.items():
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL + path,
+            secret_token=secret,
+            allowed_updates=Update.ALL_TYPES
+        )
+        logger.info(f"Вебхук @{application.bot.username}: {WEBHOOK_URL + path}")
+
+async def serve():
+    """Запускает оба бота и HTTP-сервер до сигнала остановки"""
+    if not WEBHOOK_SECRET:
+        raise RuntimeError('Для режима вебхуков задайте WEBHOOK_SECRET в .env')
+    applications = {
+        WEBHOOK_BOT_PATH: bot.build_application(),
+        WEBHOOK_ADMIN_PATH: admin_bot.build_application()
+    }
+    runner = web.AppRunner(create_web_app(applications, WEBHOOK_SECRET))
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    try:
+        await start_applications(list(applications.values()))
+        if WEBHOOK_URL:
+            await register_webhooks(applications, WEBHOOK_SECRET)
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        logger.info(f"Сервер вебхуков слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        await stop_applications(list(applications.values()))
+
+def main():
+    """Запуск обоих ботов в режиме вебхуков"""
+    asyncio.run(serve())
+
+if __name__ == '__main__':
+    main()